@@ -8,6 +8,9 @@ from util import even_split
 from peer import Peer
 
 class ArmlB1PropShare(Peer):
+    # uploads() looks back at most 1 round
+    max_lookback = 1
+
     def post_init(self):
         print "post_init(): %s here!" % self.id
         self.dummy_state = dict()
@@ -19,10 +22,10 @@ class ArmlB1PropShare(Peer):
 
         returns: a list of Request() objects
 
-        This will be called after update_pieces() with the most recent state.
+        This will be called after update_piece_changes() with the most
+        recent state.
         """
-        needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
-        needed_pieces = filter(needed, range(len(self.pieces)))
+        needed_pieces = self.needed_pieces()
         np_set = set(needed_pieces)  # sets support fast intersection ops.
 
         requests = []   # We'll put all the things we want here
@@ -83,32 +86,27 @@ class ArmlB1PropShare(Peer):
         In each round, this will be called after requests().
         """
         random.shuffle(peers)
-        round = history.current_round()
         # One could look at other stuff in the history too here.
-        # For example, history.downloads[round-1] (if round != 0, of course)
-        # has a list of Download objects for each Download to this peer in
-        # the previous round.
+        # For example, history.downloads[history.current_round() - 1] (if
+        # that's not round 0, of course) has a list of Download objects for
+        # each Download to this peer in the previous round.
 
         if len(requests) == 0:
             chosen = []
             bws = []
         else:
-            blocks_up = []
-            names = []
             requesters = [x.requester_id for x in requests]
-            for up in history.downloads[round - 1]:
-                if up.from_id not in names and up.from_id in requesters:
-                    names.append(up.from_id)
-                    blocks_up.append(up.blocks)
-                elif up.from_id in requests:
-                    blocks_up[names.index(up.from_id)] += up.blocks
+            # Blocks each requester gave us last round, totalled by History
+            received = history.received.last_round
+            names = [u for u in received if u in requesters]
+            blocks_up = [received[u] for u in names]
             blocks_tot = sum(blocks_up)
             chosen = []
             bws = []
             for p in peers:
                 if p.id in names:
                     chosen.append(p.id)
-                    bws.append(int(0.9 * self.up_bw * blocks_up[names.index(p.id)]/blocks_tot))
+                    bws.append(int(0.9 * self.up_bw * received[p.id]/blocks_tot))
             random.shuffle(peers)
             for p in peers:
                 if p.id not in names:
@@ -8,6 +8,9 @@ from util import even_split
 from peer import Peer
 
 class ArmlB1Std(Peer):
+    # uploads() looks back at most 1 round
+    max_lookback = 1
+
     def post_init(self):
         print "post_init(): %s here!" % self.id
         self.dummy_state = dict()
@@ -19,10 +22,10 @@ class ArmlB1Std(Peer):
 
         returns: a list of Request() objects
 
-        This will be called after update_pieces() with the most recent state.
+        This will be called after update_piece_changes() with the most
+        recent state.
         """
-        needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
-        needed_pieces = filter(needed, range(len(self.pieces)))
+        needed_pieces = self.needed_pieces()
         np_set = set(needed_pieces)  # sets support fast intersection ops.
 
         requests = []   # We'll put all the things we want here
@@ -83,24 +86,15 @@ class ArmlB1Std(Peer):
         In each round, this will be called after requests().
         """
         random.shuffle(peers)
-        round = history.current_round()
 
         if len(requests) == 0:
             chosen = []
             bws = []
         else:
-            uploaders = []
-            blocks_up = []
-            for up in history.downloads[round - 1]:
-                from_ = up.from_id
-                blocks = up.blocks
-                if from_ not in uploaders:
-                    uploaders.append(from_)
-                    blocks_up.append(blocks)
-                else:
-                    blocks_up[uploaders.index(from_)] += blocks
+            # Blocks each peer gave us last round, totalled by History
+            received = history.received.last_round
             requesters = [x.requester_id for x in requests]
-            chosen = [x for _,x in sorted(zip(blocks_up, uploaders)) if x in requesters][-3:]
+            chosen = [x for _,x in sorted((b, u) for (u, b) in received.items()) if x in requesters][-3:]
             request = random.choice(requests)
             chosen.append(request.requester_id)
             chosen = list(set(chosen))
@@ -8,6 +8,9 @@ from util import even_split
 from peer import Peer
 
 class ArmlB1Tourney(Peer):
+    # uploads() looks back at most 3 rounds
+    max_lookback = 3
+
     def post_init(self):
         print "post_init(): %s here!" % self.id
         self.dummy_state = dict()
@@ -19,10 +22,10 @@ class ArmlB1Tourney(Peer):
 
         returns: a list of Request() objects
 
-        This will be called after update_pieces() with the most recent state.
+        This will be called after update_piece_changes() with the most
+        recent state.
         """
-        needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
-        needed_pieces = filter(needed, range(len(self.pieces)))
+        needed_pieces = self.needed_pieces()
         np_set = set(needed_pieces)  # sets support fast intersection ops.
 
         requests = []   # We'll put all the things we want here
@@ -107,8 +110,7 @@ class ArmlB1Tourney(Peer):
             else:
                 unchoked2 = []
             ups = set([x.from_id for x in history.downloads[round - 1]])
-            for unc in peers:
-                indx = name.index(unc.id)
+            for (indx, unc) in enumerate(peers):
                 if unc not in ups:
                     t[indx] *= (1 + alpha)
                 else:
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+# Piece bitfields ################
+
+# A set of piece ids is kept as a plain python int: bit i is set if piece i
+# is in the set.  Intersection is a word-parallel &, and a peer's
+# availability costs num_pieces / 8 bytes instead of a hash set entry per
+# piece.
+
+
+def from_pieces(pieces):
+    """
+    given an iterable of piece ids, return the bitmask with those bits set
+
+    >>> from_pieces([0, 2])
+    5
+    """
+    mask = 0
+    for i in pieces:
+        mask |= 1 << i
+    return mask
+
+
+def full_mask(num_pieces):
+    """
+    the mask with all num_pieces bits set
+
+    >>> full_mask(3)
+    7
+    """
+    return (1 << num_pieces) - 1
+
+
+def has(mask, piece_id):
+    return (mask >> piece_id) & 1 == 1
+
+
+def popcount(mask):
+    """
+    number of pieces in the mask
+
+    >>> popcount(11)
+    3
+    """
+    return bin(mask).count("1")
+
+
+def iter_bits(mask):
+    """
+    yield the piece ids in the mask, in increasing order
+
+    >>> list(iter_bits(10))
+    [1, 3]
+    """
+    # Walking the binary string is linear in the mask length, where
+    # repeatedly clearing the low bit of a long int would be quadratic.
+    for (i, c) in enumerate(reversed(bin(mask)[2:])):
+        if c == "1":
+            yield i
+
+
+def to_list(mask):
+    return list(iter_bits(mask))
+
+
+def intersect(a, b):
+    """
+    the pieces in both masks
+
+    >>> to_list(intersect(from_pieces([1, 2, 3]), from_pieces([2, 3, 4])))
+    [2, 3]
+    """
+    return a & b
+
+
+def _mask_of(pieces):
+    if isinstance(pieces, PieceSet):
+        return pieces.mask
+    return from_pieces(pieces)
+
+
+class PieceSet:
+    """
+    Read-only set-like view of a piece bitmask.  This is what agents see as
+    PeerInfo.available_pieces, so code written against a set of piece ids
+    keeps working: it supports `in`, len(), iteration (in increasing piece
+    order), the set operators and methods (&, |, -, ^, intersection(),
+    union(), difference(), symmetric_difference(), issubset(),
+    issuperset(), isdisjoint()) with any iterable of piece ids, and
+    comparisons with sets.  The operators return plain sets.  Since the
+    mask is an int it can't change under the agent, so the count and the
+    ids are worked out once and kept.
+    """
+    def __init__(self, mask):
+        self.mask = mask
+        self._ids = None
+
+    def ids(self):
+        """The piece ids, in increasing order, as a tuple"""
+        if self._ids is None:
+            self._ids = tuple(iter_bits(self.mask))
+        return self._ids
+
+    def __contains__(self, piece_id):
+        return has(self.mask, piece_id)
+
+    def __len__(self):
+        return len(self.ids())
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def __nonzero__(self):
+        return self.mask != 0
+
+    def intersection(self, other):
+        """Return a set of the pieces also in other (a PieceSet or any
+        iterable of piece ids)."""
+        return set(iter_bits(self.mask & _mask_of(other)))
+
+    def union(self, other):
+        return set(iter_bits(self.mask | _mask_of(other)))
+
+    def difference(self, other):
+        return set(iter_bits(self.mask & ~_mask_of(other)))
+
+    def symmetric_difference(self, other):
+        return set(iter_bits(self.mask ^ _mask_of(other)))
+
+    def issubset(self, other):
+        return self.mask & ~_mask_of(other) == 0
+
+    def issuperset(self, other):
+        return _mask_of(other) & ~self.mask == 0
+
+    def isdisjoint(self, other):
+        return self.mask & _mask_of(other) == 0
+
+    __and__ = __rand__ = intersection
+    __or__ = __ror__ = union
+    __sub__ = difference
+    __xor__ = __rxor__ = symmetric_difference
+
+    def __rsub__(self, other):
+        return set(iter_bits(_mask_of(other) & ~self.mask))
+
+    def __eq__(self, other):
+        if not isinstance(other, (PieceSet, set, frozenset)):
+            return False
+        return self.mask == _mask_of(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __le__(self, other):
+        return self.issubset(other)
+
+    def __ge__(self, other):
+        return self.issuperset(other)
+
+    def __lt__(self, other):
+        return self.issubset(other) and self != other
+
+    def __gt__(self, other):
+        return self.issuperset(other) and self != other
+
+    def __hash__(self):
+        return hash(frozenset(self.ids()))
+
+    def __repr__(self):
+        return "PieceSet(%s)" % list(self.ids())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+Snapshot-and-fork runs for "what if" studies.
+
+Each iteration runs the lineup once up to the fork round.  There the
+process forks once per branch: every child starts from an identical copy
+of the whole run (piece tables, availability, history, the agent objects
+and the random state, shared copy-on-write), applies its branch's changes
+and plays the rest of the run.  The parent carries on unchanged as the
+base branch.  The rounds before the fork are only simulated once, however
+many branches there are.
+
+A branch is a comma-separated list of changes:
+    PEER_ID=AgentClass   the agent playing PEER_ID switches to a fresh
+                         AgentClass (same id, pieces and bandwidth)
+    option=value         a sim option, e.g. max_round=400
+
+    branching.py --fork-round 50 --branch ArmlB1Std0=ArmlB1Tyrant \\
+        --branch ArmlB1Std0=ArmlB1PropShare [sim options] ArmlB1Std,4 Seed
+"""
+
+import os
+import sys
+import cPickle
+import logging
+import traceback
+
+from sim import (Sim, SimResult, configure_logging, make_config,
+                 make_option_parser, parse_agents)
+from paired import summarize
+from util import load_modules
+
+
+class BranchError(Exception):
+    pass
+
+
+def parse_branch(spec):
+    """'A=B,C=D' -> [("A", "B"), ("C", "D")]"""
+    changes = []
+    for part in spec.split(","):
+        if "=" not in part:
+            raise ValueError("Bad branch change (want NAME=VALUE): %s" % part)
+        (name, value) = part.split("=", 1)
+        changes.append((name.strip(), value.strip()))
+    return changes
+
+
+def apply_branch(state, changes):
+    """Apply one branch's changes to a SimState."""
+    for (name, value) in changes:
+        if name in state.peer_ids:
+            agent_class = load_modules([value])[value]
+            state.replace_agent(name, agent_class)
+        elif hasattr(state.config, name) and name not in (
+                "agent_classes", "agent_class_names"):
+            current = getattr(state.config, name)
+            if isinstance(current, bool):
+                value = value.lower() in ("1", "true", "yes")
+            elif current is not None:
+                value = type(current)(value)
+            setattr(state.config, name, value)
+        else:
+            raise ValueError("Branch change names neither a peer nor an option: %s"
+                             % name)
+
+
+def read_all(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(fd)
+    return "".join(chunks)
+
+
+def run_forked_iteration(sim, seed, fork_round, branches, procs):
+    """
+    Run one iteration, forking at fork_round.  Returns (the base branch's
+    SimResult, [SimResult per branch]).
+    """
+    children = []   # (branch index, pid, read end of its pipe)
+    results = [None] * len(branches)
+    me = dict(branch=None, fd=None)
+
+    def collect(child):
+        (k, pid, fd) = child
+        data = read_all(fd)
+        os.waitpid(pid, 0)
+        if not data:
+            raise BranchError("Branch %d died without a result" % k)
+        (status, value) = cPickle.loads(data)
+        if status != "ok":
+            raise BranchError("Branch %d failed:\n%s" % (k, value))
+        results[k] = value
+
+    def fork_hook(state):
+        for (k, changes) in enumerate(branches):
+            while len(children) >= procs:
+                collect(children.pop(0))
+            (r, w) = os.pipe()
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                os.close(r)
+                for (_, _, fd) in children:
+                    os.close(fd)
+                del children[:]
+                me["branch"] = k
+                me["fd"] = w
+                apply_branch(state, changes)
+                # The child plays out the rest of the run on its branch.
+                return
+            os.close(w)
+            children.append((k, pid, r))
+
+    sim.fork_hook = (fork_round, fork_hook)
+    try:
+        history = sim.run_sim_once(seed)
+        outcome = ("ok", SimResult(sim.peer_ids, [history]))
+    except Exception:
+        if me["branch"] is None:
+            raise
+        outcome = ("error", traceback.format_exc())
+    finally:
+        sim.fork_hook = None
+
+    if me["branch"] is not None:
+        try:
+            data = cPickle.dumps(outcome, cPickle.HIGHEST_PROTOCOL)
+            while data:
+                data = data[os.write(me["fd"], data):]
+            os.close(me["fd"])
+            sys.stdout.flush()
+        finally:
+            os._exit(0)
+
+    for child in children:
+        collect(child)
+    if None in results:
+        raise BranchError("The run finished before round %d; nothing was forked"
+                          % fork_round)
+    return (outcome[1], results)
+
+
+def run_branches(config, fork_round, branches, procs=1):
+    """
+    config: sim Params
+    branches: list of branches, each a list of (name, value) changes
+    procs: at most this many branch processes at a time
+
+    Returns (base SimResult, [SimResult per branch]), over config.iters
+    iterations.
+    """
+    if config.workers > 0:
+        raise ValueError("Forked runs don't support --workers")
+    sim = Sim(config)
+    # Load the classes being switched to now, so a typo shows up before
+    # anything runs, and keep as much history as they look back at.
+    for changes in branches:
+        for (name, value) in changes:
+            if hasattr(config, name):
+                continue
+            lookback = load_modules([value])[value].max_lookback
+            if name in sim.min_lookbacks and (
+                    lookback is None or sim.min_lookbacks[name] is None):
+                lookback = None
+            elif name in sim.min_lookbacks:
+                lookback = max(lookback, sim.min_lookbacks[name])
+            sim.min_lookbacks[name] = lookback
+    base = None
+    branch_results = None
+    for i in range(config.iters):
+        (b, rs) = run_forked_iteration(sim, sim.iteration_seed(i), fork_round,
+                                       branches, max(1, procs))
+        if base is None:
+            (base, branch_results) = (b, rs)
+        else:
+            base.extend(b)
+            for (acc, r) in zip(branch_results, rs):
+                acc.extend(r)
+    return (base, branch_results)
+
+
+def log_branches(labels, base, results):
+    def diffs(ds_base, ds_branch, pid):
+        return [d[pid] - b[pid] for (b, d) in zip(ds_base, ds_branch)
+                if b[pid] is not None and d[pid] is not None]
+
+    def fmt(diffs):
+        (m, sd, se) = summarize(diffs)
+        if m is None:
+            return "n/a"
+        return "%+.2f  (se %.2f, n=%d)" % (m, se, len(diffs))
+
+    for (label, r) in zip(labels, results):
+        logging.warning("======== BRANCH %s (vs base) ========" % label)
+        done = [(b, d) for (b, d) in zip(base.all_done_rounds, r.all_done_rounds)
+                if b is not None and d is not None]
+        logging.warning("All done round: %s" % fmt([d - b for (b, d) in done]))
+        logging.warning("Completion rounds / uploaded blocks: mean diff")
+        for pid in r.peer_ids:
+            logging.warning("%s: %s / %s" % (
+                pid, fmt(diffs(base.completion_rounds, r.completion_rounds, pid)),
+                fmt(diffs(base.uploaded_blocks, r.uploaded_blocks, pid))))
+
+
+def main(args):
+    parser = make_option_parser()
+    parser.set_usage("Usage:  %prog --fork-round R --branch CHANGES [--branch CHANGES ...] [options] PeerClass1[,count] ...")
+
+    parser.add_option("--fork-round",
+                      dest="fork_round", default=None, type="int",
+                      help="Round at which to fork the branches")
+
+    parser.add_option("--branch",
+                      dest="branches", default=[], action="append",
+                      help="Changes for one branch: PEER_ID=Class or option=value, comma-separated")
+
+    parser.add_option("--procs",
+                      dest="procs", default=1, type="int",
+                      help="Run up to N branches at a time")
+
+    (options, args) = parser.parse_args()
+    if options.fork_round is None or not options.branches:
+        parser.print_help()
+        sys.exit(1)
+
+    if len(args) == 0:
+        agents_to_run = ['Dummy', 'Dummy', 'Seed']
+    else:
+        agents_to_run = parse_agents(args)
+
+    configure_logging(options.loglevel)
+    config = make_config(options, agents_to_run)
+    branches = [parse_branch(b) for b in options.branches]
+    (base, results) = run_branches(config, options.fork_round, branches,
+                                   options.procs)
+    logging.warning("Base all done rounds: %s" % base.all_done_rounds)
+    log_branches(options.branches, base, results)
+
+if __name__ == "__main__":
+    main(sys.argv)
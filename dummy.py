@@ -12,6 +12,7 @@ import logging
 from messages import Upload, Request
 from util import even_split
 from peer import Peer
+import bitfield
 
 class Dummy(Peer):
     def post_init(self):
@@ -25,11 +26,13 @@ class Dummy(Peer):
 
         returns: a list of Request() objects
 
-        This will be called after update_pieces() with the most recent state.
+        This will be called after update_piece_changes() with the most
+        recent state.
         """
-        needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
-        needed_pieces = filter(needed, range(len(self.pieces)))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        needed_pieces = self.needed_pieces()
+        # Bitmasks support even faster intersection ops than sets: bit i is
+        # set if we still need piece i.  See bitfield.py.
+        np_mask = self.needed_mask()
 
 
         logging.debug("%s here: still need pieces %s" % (
@@ -48,13 +51,13 @@ class Dummy(Peer):
         random.shuffle(needed_pieces)
 
         # Sort peers by id.  This is probably not a useful sort, but other
-        # sorts might be useful
+        # sorts might be useful.  (peers is a PeerView shared with the other
+        # agents; sorting or shuffling it gives you your own copy.)
         peers.sort(key=lambda p: p.id)
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
+            isect = bitfield.to_list(peer.available_mask & np_mask)
             n = min(self.max_requests, len(isect))
             # More symmetry breaking -- ask for random pieces.
             # This would be the place to try fancier piece-requesting strategies
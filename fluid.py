@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""
+A mean-field (fluid) estimate of a swarm, for screening configs before
+spending CPU on the discrete sim.
+
+Blocks are treated as a continuous quantity, and the peers of each agent
+class as one group that moves together: the model tracks a group's
+mean progress and total upload capacity, not each peer's.  Every round,
+each group's capacity is split over the peers that still need something
+and every group's progress moves forward by what its peers were given,
+so a run costs O(rounds * classes^2) arithmetic however many peers there
+are, and no agent calls.  A class's uploads are shared out over its peers
+in proportion to bandwidth.  Around the mean, a peer's progress spreads
+out as if its blocks arrived as a Poisson stream, which gives each class
+a distribution of completion rounds: the share of its peers done by each
+round, reported as quantiles.  The model knows nothing about the agents
+beyond which peers are seeds; the split follows a simple allocation
+policy:
+
+    even:        every uploader splits its capacity evenly
+    reciprocal:  seeds split evenly; other peers split in proportion to
+                 what each receiver could upload back (tit-for-tat-like)
+
+Rarest-first is assumed to keep pieces spread out, so an uploader has
+something to offer a receiver in proportion to the blocks it holds that
+the receiver lacks.  A peer can only upload once it has finished pieces.
+Only `efficiency` of the upload capacity turns into new blocks: in the
+sim, uploads of the same piece to one requester don't add up, and
+uploaders don't always fill their bandwidth.  The default comes from
+calibrating against the bundled agents; --calibrate suggests a value for
+other lineups and configs.
+
+    fluid.py [sim options] [--fluid-policy P] [--calibrate] PeerClass1[,count] ...
+
+--calibrate also runs the discrete sim on the same bandwidths (common
+random numbers, see Sim.run_sim_once) and reports how far off the
+estimate is per agent class.
+"""
+
+import sys
+import math
+import time
+import random
+import logging
+
+from sim import (Sim, SimResult, configure_logging, make_config,
+                 make_option_parser, parse_agents, peer_ids_for)
+from parallel import sim_rng_state
+from util import mean, stddev
+
+POLICIES = ("even", "reciprocal")
+# Completion-round percentiles to report
+QUANTILES = (10, 50, 90)
+# Stop once all but this share of every class is done
+TAIL = 1e-3
+
+
+class FluidResult(SimResult):
+    """
+    Same shape as SimResult, one entry per iteration; completion_rounds
+    and all_done_rounds hold the median rounds.  Also:
+
+    completion_cdfs: [dict : agent class -> [share of its peers done by
+                      round r, for each r]]
+    """
+    def __init__(self, peer_ids):
+        self.peer_ids = peer_ids
+        self.upload_rates = []
+        self.uploaded_blocks = []
+        self.completion_rounds = []
+        self.all_done_rounds = []
+        self.completion_cdfs = []
+        self.histories = None
+
+    def add(self, upload_rates, uploaded, completion, cdfs, all_done):
+        self.upload_rates.append(upload_rates)
+        self.uploaded_blocks.append(uploaded)
+        self.completion_rounds.append(completion)
+        self.completion_cdfs.append(cdfs)
+        self.all_done_rounds.append(all_done)
+
+    def class_cdf(self, name):
+        """The share of a class's peers done by each round, over all
+        iterations."""
+        cdfs = [d[name] for d in self.completion_cdfs]
+        n = max(len(cdf) for cdf in cdfs)
+        return [mean([cdf[min(r, len(cdf) - 1)] for cdf in cdfs])
+                for r in range(n)]
+
+
+def done_share(reach, var, size):
+    """The share of peers that hold all size blocks, when they hold reach
+    on average with variance var."""
+    if var <= 0:
+        return 1.0 if reach >= size - 1e-9 else 0.0
+    return 0.5 * math.erfc((size - reach) / math.sqrt(2 * var))
+
+
+def first_round(cdf, share):
+    """The first round by which share of the peers are done, or None."""
+    for (r, done) in enumerate(cdf):
+        if done >= share:
+            return r
+    return None
+
+
+class FluidModel:
+    def __init__(self, config, policy="even", efficiency=0.5):
+        if policy not in POLICIES:
+            raise ValueError("Unknown fluid policy %s (want one of %s)" % (
+                policy, ", ".join(POLICIES)))
+        self.config = config
+        self.policy = policy
+        self.efficiency = efficiency
+        self.peer_ids = peer_ids_for(config.agent_class_names)
+        self.is_seed = [pid.startswith("Seed") for pid in self.peer_ids]
+        self.class_names = config.agent_class_names
+
+    def bandwidths(self, rng):
+        """Draw upload bandwidths the way Sim.up_bw does."""
+        c = self.config
+        return [c.max_up_bw if seed else rng.randint(c.min_up_bw, c.max_up_bw)
+                for seed in self.is_seed]
+
+    def run_once(self, up_bws):
+        """
+        Returns (uploaded, completion, cdfs, all_done): dicts : peer_id ->
+        blocks uploaded, and -> median round finished (or None); agent
+        class -> share of its peers done by each round; and the median
+        round everyone is done (or None).
+        """
+        c = self.config
+        size = float(c.num_pieces * c.blocks_per_piece)
+        names = sorted(set(self.class_names))
+        members = [[i for (i, name) in enumerate(self.class_names) if name == g]
+                   for g in names]
+        m = len(names)
+        count = [len(ps) for ps in members]
+        bw = [sum(up_bws[i] for i in ps) for ps in members]
+        seed = [self.is_seed[ps[0]] for ps in members]
+        # Per group: mean blocks held
+        have = [size if seed[g] else 0.0 for g in range(m)]
+        uploaded = [0.0] * m
+        # A peer's progress: the blocks it would hold if none were turned
+        # away, and their variance.  Each round adds what the group was
+        # offered to both; once the mean is complete, the stragglers keep
+        # the best pace the group had, rather than the trickle the mean
+        # gets as it runs out of pieces to ask for.
+        reach = list(have)
+        var = [0.0] * m
+        pace = [0.0] * m
+        cdfs = [[] for g in range(m)]
+
+        for round in range(c.max_round + 1):
+            active = [g for g in range(m) if have[g] < size - 1e-9]
+            # Per peer of the group; only finished pieces can be uploaded.
+            cap = [self.efficiency * bw[g] / count[g] *
+                   min(1.0, have[g] / c.blocks_per_piece)
+                   for g in range(m)]
+            got = [0.0] * m          # per receiving peer
+            given = [[] for g in range(m)]  # (receiver group, blocks in all)
+            for j in range(m):
+                if cap[j] == 0:
+                    continue
+                # Receivers one uploader of j sees: everyone active but itself
+                others = [(i, count[i] - (i == j)) for i in active]
+                others = [(i, k) for (i, k) in others if k > 0]
+                if not others:
+                    continue
+                if self.policy == "reciprocal" and not seed[j]:
+                    weights = [cap[i] for (i, k) in others]
+                    if sum(weights) == 0:
+                        weights = [1.0] * len(others)
+                else:
+                    weights = [1.0] * len(others)
+                total = float(sum(w * k for (w, (i, k)) in zip(weights, others)))
+                for (w, (i, k)) in zip(weights, others):
+                    # Blocks j holds that i is missing, with pieces spread
+                    # out by rarest-first
+                    useful = have[j] * (1.0 - have[i] / size)
+                    blocks = min(cap[j] * w / total, useful)
+                    if blocks > 0:
+                        # Each peer of i hears from every peer of j but itself
+                        senders = count[j] - (i == j)
+                        got[i] += blocks * senders
+                        given[j].append((i, blocks * senders * count[i]))
+            # Nobody takes more than they still need.
+            scale = [1.0] * m
+            for i in active:
+                if got[i] > size - have[i]:
+                    scale[i] = (size - have[i]) / got[i]
+            for j in range(m):
+                for (i, blocks) in given[j]:
+                    uploaded[j] += blocks * scale[i]
+            for i in active:
+                have[i] += got[i] * scale[i]
+                pace[i] = max(pace[i], got[i])
+            for g in range(m):
+                step = got[g] if g in active else pace[g]
+                reach[g] += step
+                var[g] += step
+                share = done_share(reach[g], var[g], size)
+                if cdfs[g]:
+                    share = max(share, cdfs[g][-1])
+                cdfs[g].append(share)
+            if min(cdf[-1] for cdf in cdfs) >= 1 - TAIL:
+                break
+
+        up = dict()
+        completion = dict()
+        for (g, ps) in enumerate(members):
+            done = first_round(cdfs[g], 0.5)
+            for i in ps:
+                pid = self.peer_ids[i]
+                up[pid] = uploaded[g] * up_bws[i] / max(bw[g], 1)
+                completion[pid] = done
+        # Everyone is done once each peer of each class is
+        everyone = [reduce(lambda a, g: a * cdfs[g][r] ** count[g], range(m), 1.0)
+                    for r in range(len(cdfs[0]))]
+        return (up, completion, dict(zip(names, cdfs)),
+                first_round(everyone, 0.5))
+
+    def estimate(self, seed=None):
+        """
+        Run config.iters iterations and return a FluidResult.  With
+        config.crn_seed, iteration i draws the same bandwidths as the
+        discrete sim's iteration i does.
+        """
+        c = self.config
+        result = FluidResult(self.peer_ids)
+        rng = random.Random(seed)
+        for i in range(c.iters):
+            if c.crn_seed is not None:
+                rng = random.Random()
+                rng.setstate(sim_rng_state(c.crn_seed + i))
+            up_bws = self.bandwidths(rng)
+            (uploaded, completion, cdfs, all_done) = self.run_once(up_bws)
+            result.add(dict(zip(self.peer_ids, up_bws)), uploaded, completion,
+                       cdfs, all_done)
+        return result
+
+
+def by_class(config, result):
+    """agent class -> [completion rounds of its peers, None if unfinished],
+    over all iterations"""
+    ans = dict()
+    for d in result.completion_rounds:
+        for (name, pid) in zip(config.agent_class_names, result.peer_ids):
+            ans.setdefault(name, []).append(d[pid])
+    return ans
+
+
+def round_quantiles(rs, ps=QUANTILES):
+    """Nearest-rank percentiles of completion rounds, unfinished (None)
+    counted as last."""
+    rs = sorted(rs, key=lambda r: (r is None, r))
+    return [rs[max(0, int(math.ceil(p / 100.0 * len(rs))) - 1)] for p in ps]
+
+
+def cdf_quantiles(cdf, ps=QUANTILES):
+    return [first_round(cdf, p / 100.0) for p in ps]
+
+
+def fmt_quantiles(qs):
+    return " / ".join("never" if q is None else "%d" % q for q in qs)
+
+
+def fmt_rounds(rs):
+    finished = [r for r in rs if r is not None]
+    if not finished:
+        return "never"
+    s = "%.1f  (%.1f)" % (mean(finished), stddev(finished))
+    if len(finished) < len(rs):
+        s += ", %d/%d unfinished" % (len(rs) - len(finished), len(rs))
+    return s
+
+
+def log_estimate(config, result):
+    logging.warning("======== FLUID ESTIMATE ========")
+    logging.warning("Completion rounds: %s" % " / ".join(
+        "p%d" % p for p in QUANTILES))
+    for name in sorted(set(config.agent_class_names)):
+        cdf = result.class_cdf(name)
+        s = fmt_quantiles(cdf_quantiles(cdf))
+        if cdf[-1] < 1 - TAIL:
+            s += ", %.0f%% unfinished" % (100.0 * (1 - cdf[-1]))
+        logging.warning("%s: %s" % (name, s))
+    logging.warning("All done round (median): %s" %
+                    fmt_rounds(result.all_done_rounds))
+
+
+def calibrate(config, policy="even", efficiency=0.5):
+    """
+    Run the discrete sim and the fluid model on the same bandwidths.
+    Returns (FluidModel, SimResult, FluidResult, sim seconds, fluid
+    seconds).
+    """
+    if config.crn_seed is None:
+        config.crn_seed = random.getrandbits(32)
+    start = time.time()
+    sim = Sim(config)
+    histories = [sim.run_sim_once(sim.iteration_seed(i))
+                 for i in range(config.iters)]
+    sim_result = SimResult(sim.peer_ids, histories)
+    sim_secs = time.time() - start
+
+    start = time.time()
+    model = FluidModel(config, policy, efficiency)
+    fluid_result = model.estimate()
+    return (model, sim_result, fluid_result, sim_secs, time.time() - start)
+
+
+def log_calibration(config, model, sim_result, fluid_result, sim_secs,
+                    fluid_secs):
+    """Per agent class: the sim's and the model's completion round
+    percentiles, and the mean and mean absolute per-peer error of the
+    model's median (model - sim).  Also suggests an efficiency that would
+    line up the mean all-done round."""
+    logging.warning("======== FLUID CALIBRATION (crn seed %d) ========" %
+                    config.crn_seed)
+    logging.warning("sim %.3fs, fluid %.3fs" % (sim_secs, fluid_secs))
+    logging.warning("Completion rounds: sim %s | fluid same | error avg (abs)" %
+                    " / ".join("p%d" % p for p in QUANTILES))
+    sim_classes = by_class(config, sim_result)
+    fluid_classes = by_class(config, fluid_result)
+    for name in sorted(sim_classes):
+        pairs = [(s, f) for (s, f) in zip(sim_classes[name], fluid_classes[name])
+                 if s is not None and f is not None]
+        errors = [f - s for (s, f) in pairs]
+        if errors:
+            err = "%+.1f  (%.1f)" % (mean(errors), mean(map(abs, errors)))
+        else:
+            err = "n/a"
+        logging.warning("%s: %s | %s | %s" % (
+            name, fmt_quantiles(round_quantiles(sim_classes[name])),
+            fmt_quantiles(cdf_quantiles(fluid_result.class_cdf(name))), err))
+    logging.warning("All done round: %s / %s" % (
+        fmt_rounds(sim_result.all_done_rounds),
+        fmt_rounds(fluid_result.all_done_rounds)))
+
+    pairs = [(s, f) for (s, f) in zip(sim_result.all_done_rounds,
+                                      fluid_result.all_done_rounds)
+             if s and f]
+    if pairs:
+        # Rounds to finish go roughly as 1 / efficiency.
+        suggested = model.efficiency * mean([f for (s, f) in pairs]) / \
+            mean([s for (s, f) in pairs])
+        logging.warning("Suggested --fluid-efficiency: %.2f" % suggested)
+
+
+def main(args):
+    parser = make_option_parser()
+
+    parser.add_option("--fluid-policy",
+                      dest="fluid_policy", default="even",
+                      help="Upload allocation in the model: %s" % " or ".join(POLICIES))
+
+    parser.add_option("--fluid-efficiency",
+                      dest="fluid_efficiency", default=0.5, type="float",
+                      help="Fraction of upload capacity that becomes new blocks in the model")
+
+    parser.add_option("--calibrate",
+                      dest="calibrate", default=False, action="store_true",
+                      help="Also run the discrete sim and report the model's error")
+
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        agents_to_run = ['Dummy', 'Dummy', 'Seed']
+    else:
+        agents_to_run = parse_agents(args)
+
+    configure_logging(options.loglevel)
+    config = make_config(options, agents_to_run)
+    if options.calibrate:
+        log_calibration(config, *calibrate(config, options.fluid_policy,
+                                           options.fluid_efficiency))
+    else:
+        model = FluidModel(config, options.fluid_policy, options.fluid_efficiency)
+        log_estimate(config, model.estimate())
+
+if __name__ == "__main__":
+    main(sys.argv)
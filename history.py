@@ -2,6 +2,195 @@
 
 import copy
 import pprint
+from collections import deque
+
+
+class RoundWindow:
+    """
+    Per-round records for one peer, keeping only the last `size` rounds.
+
+    Behaves like the plain list it replaces as far as agents looking back a
+    bounded number of rounds are concerned: len() is the number of rounds
+    recorded so far, and w[r] / w[-k] index by absolute round.  Asking for
+    a round that has dropped out of the window raises IndexError, and so
+    does iterating once it reaches one, so iteration and len() never
+    disagree.  in_window() lists the rounds still held.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._items = deque(maxlen=size)
+        self._count = 0
+
+    def append(self, x):
+        self._items.append(x)
+        self._count += 1
+
+    def first_round(self):
+        """The oldest round still in the window"""
+        return len(self) - len(self._items)
+
+    def has_round(self, r):
+        return self.first_round() <= r < len(self)
+
+    def in_window(self):
+        return list(self._items)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        n = len(self)
+        if isinstance(i, slice):
+            return [self[r] for r in range(*i.indices(n))]
+        if i < 0:
+            i += n
+        if not self.has_round(i):
+            raise IndexError("round %d is outside the %d-round history window"
+                             % (i, self.size))
+        return self._items[i - self.first_round()]
+
+    def __iter__(self):
+        for r in xrange(len(self)):
+            yield self[r]
+
+    def __repr__(self):
+        return "%s(first_round=%d, %s)" % (
+            self.__class__.__name__, self.first_round(),
+            pprint.pformat(self.in_window()))
+
+
+class RoundView(RoundWindow):
+    """
+    A read-only RoundWindow over a full per-round list: what an agent with
+    a max_lookback sees when the History keeps every round anyway.
+    """
+    def __init__(self, rounds, size):
+        self.size = size
+        self._rounds = rounds
+
+    def append(self, x):
+        raise TypeError("RoundView is read-only")
+
+    def first_round(self):
+        return max(len(self._rounds) - self.size, 0)
+
+    def in_window(self):
+        return self._rounds[self.first_round():]
+
+    def __len__(self):
+        return len(self._rounds)
+
+    def __getitem__(self, i):
+        n = len(self)
+        if isinstance(i, slice):
+            return [self[r] for r in range(*i.indices(n))]
+        if i < 0:
+            i += n
+        if not self.has_round(i):
+            raise IndexError("round %d is outside the %d-round history window"
+                             % (i, self.size))
+        return self._rounds[i]
+
+
+def round_list(lookback):
+    """Storage for one peer's per-round records: a plain list, or a
+    RoundWindow if the peer only looks back `lookback` rounds."""
+    if lookback is None:
+        return []
+    return RoundWindow(lookback)
+
+
+class ReceivedTotals:
+    """
+    Blocks one peer received from each of the others, kept up to date one
+    round at a time so reciprocity-based agents don't have to re-walk their
+    downloads.
+
+    last_round: dict : peer_id -> blocks received from it in the last round
+    in_window: dict : peer_id -> blocks received from it over the last
+        `window` rounds
+    """
+    def __init__(self, window):
+        self.window = window
+        self.last_round = dict()
+        self.in_window = dict()
+        self._rounds = deque()
+
+    def add_round(self, downloads):
+        got = dict()
+        for d in downloads:
+            got[d.from_id] = got.get(d.from_id, 0) + d.blocks
+        self.last_round = got
+        self._rounds.append(got)
+        for (pid, blocks) in got.iteritems():
+            self.in_window[pid] = self.in_window.get(pid, 0) + blocks
+        if len(self._rounds) > self.window:
+            for (pid, blocks) in self._rounds.popleft().iteritems():
+                left = self.in_window[pid] - blocks
+                if left == 0:
+                    del self.in_window[pid]
+                else:
+                    self.in_window[pid] = left
+
+    def __repr__(self):
+        return "ReceivedTotals(last_round=%s, in_window=%s)" % (
+            self.last_round, self.in_window)
+
+
+class PeerTable:
+    """
+    Per-peer values kept in a list by peer position, as the sim indexes
+    them, that still read like the dict : peer_id -> value they replace:
+    t[peer_id], `in`, len(), iteration over the ids, keys(), values(),
+    items() and get().  Code that wants the positions uses t.by_pos.
+    """
+    def __init__(self, peer_ids, index, by_pos):
+        """
+        peer_ids: the ids in position order
+        index: dict : peer_id -> position, shared between tables
+        by_pos: the values, one per position
+        """
+        self.peer_ids = peer_ids
+        self.index = index
+        self.by_pos = by_pos
+
+    def __getitem__(self, peer_id):
+        return self.by_pos[self.index[peer_id]]
+
+    def __setitem__(self, peer_id, value):
+        self.by_pos[self.index[peer_id]] = value
+
+    def __contains__(self, peer_id):
+        return peer_id in self.index
+
+    def __len__(self):
+        return len(self.by_pos)
+
+    def __iter__(self):
+        return iter(self.peer_ids)
+
+    def get(self, peer_id, default=None):
+        if peer_id in self.index:
+            return self[peer_id]
+        return default
+
+    def keys(self):
+        return list(self.peer_ids)
+
+    def values(self):
+        return list(self.by_pos)
+
+    def items(self):
+        return zip(self.peer_ids, self.by_pos)
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return pprint.pformat(dict(self.items()))
 
 
 class AgentHistory:
@@ -14,14 +203,21 @@ class AgentHistory:
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
 
+    If the agent declares a max_lookback (see Peer), these are RoundWindows
+    holding only the last max_lookback rounds.
+
+    history.received: ReceivedTotals
+         Blocks this agent got from each peer in the last round, and over
+         the last few rounds.
     """
-    def __init__(self, peer_id, downloads, uploads):
+    def __init__(self, peer_id, downloads, uploads, received=None):
         """
         Pull out just the info for peer_id.
         """
         self.uploads = uploads
         self.downloads = downloads
         self.peer_id = peer_id
+        self.received = received
 
     def last_round(self):
         return len(self.downloads)-1
@@ -36,35 +232,103 @@ class AgentHistory:
             pprint.pformat(self.uploads))
 
 
+def format_round(r, peer_ids, downloads):
+    """Round r's downloads as text; downloads: a list of Downloads per
+    peer, in peer_ids order."""
+    s = "\nRound %s:\n" % r
+    for (peer_id, ds) in zip(peer_ids, downloads):
+        stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
+            peer_id, d.blocks, d.piece, d.from_id)
+        s += "".join(map(stringify, ds))
+    return s
+
+
 class History:
     """History of the whole sim"""
-    def __init__(self, peer_ids, upload_rates):
+
+    # Rounds covered by the sliding-window totals in ReceivedTotals
+    received_window = 3
+
+    def __init__(self, peer_ids, upload_rates, lookbacks=None, keep_all=False):
         """
+        The per-peer tables below are PeerTables: lists by peer position
+        underneath, readable by peer id.
+
         uploads:
                    dict : peer_id -> [[uploads] -- one list per round]
         downloads:
                    dict : peer_id -> [[downloads] -- one list per round]
+        uploaded:
+                   dict : peer_id -> total blocks uploaded so far
+        downloaded:
+                   dict : peer_id -> total blocks downloaded so far
+        received:
+                   dict : peer_id -> ReceivedTotals, blocks received from
+                   each other peer last round and over a sliding window
+        round_totals:
+                   [blocks moved in the round -- one per round]
                    
         Keep track of the uploads _from_ and downloads _to_ the
         specified peer id.
+
+        lookbacks: dict : peer_id -> number of rounds to keep, or None to
+        keep them all (the default for every peer).
+        keep_all: keep every round anyway (for logs and callers that want
+        the whole game), and only window what peer_history() hands out.
         """
         self.upload_rates = upload_rates  # peer_id -> up_bw
         self.peer_ids = peer_ids[:]
+        if lookbacks is None:
+            lookbacks = dict()
+        # peer_id -> lookback, for the views peer_history() hands out
+        self.views = dict()
+        if keep_all:
+            self.views = lookbacks
+            lookbacks = dict()
+        self.index = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+
+        def table(by_pos):
+            return PeerTable(self.peer_ids, self.index, by_pos)
 
         self.round_done = dict()   # peer_id -> round finished
-        self.downloads = dict((pid, []) for pid in peer_ids)
-        self.uploads = dict((pid, []) for pid in peer_ids)
+        self.downloads = table([round_list(lookbacks.get(pid))
+                                for pid in self.peer_ids])
+        self.uploads = table([round_list(lookbacks.get(pid))
+                              for pid in self.peer_ids])
+        # Kept as we go, since windowed peers drop their old downloads, and
+        # so stats and agents can read them without re-walking history.
+        self.uploaded = table([0] * len(self.peer_ids))
+        self.downloaded = table([0] * len(self.peer_ids))
+        self.received = table([ReceivedTotals(self.received_window)
+                               for pid in self.peer_ids])
+        self.round_totals = []
 
     def update(self, dls, ups):
         """
-        dls: dict : peer_id -> [downloads] -- downloads for this round
-        ups: dict : peer_id -> [uploads] -- uploads for this round
+        dls: [[downloads]] -- downloads for this round, one list per peer
+            by position
+        ups: [[uploads]] -- uploads for this round, likewise
 
         append these downloads to to the history
         """
-        for pid in self.peer_ids:
-            self.downloads[pid].append(dls[pid])
-            self.uploads[pid].append(ups[pid])
+        total = 0
+        index = self.index
+        downloads = self.downloads.by_pos
+        uploads = self.uploads.by_pos
+        uploaded = self.uploaded.by_pos
+        downloaded = self.downloaded.by_pos
+        received = self.received.by_pos
+        for i in range(len(self.peer_ids)):
+            downloads[i].append(dls[i])
+            uploads[i].append(ups[i])
+            got = 0
+            for d in dls[i]:
+                uploaded[index[d.from_id]] += d.blocks
+                got += d.blocks
+            downloaded[i] += got
+            total += got
+            received[i].add_round(dls[i])
+        self.round_totals.append(total)
 
     def peer_is_done(self, round, peer_id):
         # Only save the _first_ round where we hear this
@@ -72,7 +336,21 @@ class History:
             self.round_done[peer_id] = round
 
     def peer_history(self, peer_id):
-        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id])
+        downloads = self.downloads[peer_id]
+        uploads = self.uploads[peer_id]
+        lookback = self.views.get(peer_id)
+        if lookback is not None:
+            downloads = RoundView(downloads, lookback)
+            uploads = RoundView(uploads, lookback)
+        return AgentHistory(peer_id, downloads, uploads, self.received[peer_id])
+
+    def received_from(self, receiver_id, sender_id, window=False):
+        """Blocks receiver got from sender in the last round, or over the
+        last received_window rounds if window is True."""
+        totals = self.received[receiver_id]
+        if window:
+            return totals.in_window.get(sender_id, 0)
+        return totals.last_round.get(sender_id, 0)
 
     def last_round(self):
         """index of the last completed round"""
@@ -80,13 +358,15 @@ class History:
         return len(self.downloads[p])-1
 
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
+        downloads = []
         for peer_id in self.peer_ids:
-            ds = self.downloads[peer_id][r]
-            stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
-                peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+            ds = self.downloads[peer_id]
+            if isinstance(ds, RoundWindow) and not ds.has_round(r):
+                # Dropped out of this peer's history window
+                downloads.append(())
+            else:
+                downloads.append(ds[r])
+        return format_round(r, self.peer_ids, downloads)
 
     def pretty(self):
         s = "History\n"
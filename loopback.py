@@ -0,0 +1,654 @@
+#!/usr/bin/env python
+
+"""
+Runs the agents over real sockets on the loopback interface, to see how
+strategies behave with actual message latency and socket throughput.
+
+Each peer gets one TCP connection to every other peer on 127.0.0.1, and a
+single poll() event loop drives all of them (Python 2 has no asyncio).  A
+round goes:
+
+  1. every agent's requests() is called, and each Request goes out as a
+     REQUEST frame to the peer it asks, then a REQUESTS_DONE frame goes to
+     every other peer;
+  2. as soon as a peer has REQUESTS_DONE from everyone, its uploads() is
+     called with the requests it got (in requester order, as in the sim),
+     and it streams the granted blocks as BLOCK frames of --block-bytes
+     (a fraction of a block, from agents that hand out fractional
+     bandwidth, goes as a shorter frame), then BLOCKS_DONE to everyone.
+     All of a peer's BLOCK frames go through a token bucket of up_bw
+     blocks per --round-seconds;
+  3. once everyone has BLOCKS_DONE from everyone, the round's downloads
+     are the blocks that actually arrived.  As in the sim, the same piece
+     from several uploaders, or asked for twice, doesn't add up.
+
+Otherwise the game is the sim's, so with --crn-seed the histories match
+sim.py's for the same seed.  --neighbors, --workers, --sparse-pieces and
+--fast-forward aren't supported.
+
+Both ends of every connection live in this one process, so N peers need
+N * (N - 1) sockets, plus N listeners while connecting: about 1000 file
+descriptors for 32 peers, past the usual soft limit of 1024 soon after.
+The run checks RLIMIT_NOFILE before opening anything and stops with a
+LoopbackError saying how many it needs; raise the limit (ulimit -n) to
+run more peers.
+
+    loopback.py [sim options] [--block-bytes B] [--round-seconds S] PeerClass1[,count] ...
+
+Reports the achieved throughput, latency percentiles (REQUEST frame
+delivery, and request to first block) and how the wall time splits
+between the agents, waiting on sockets and the event loop itself.
+"""
+
+import sys
+import copy
+import time
+import errno
+import random
+import select
+import resource
+import socket
+import struct
+import logging
+from collections import deque
+
+from messages import Upload, Request, Download, PeerInfo, PeerView
+from history import History
+from parallel import call_with_rng, peer_rng_states, sim_rng_state
+from sim import (Sim, SimResult, configure_logging, make_config,
+                 make_option_parser, parse_agents, peer_ids_for)
+from util import IllegalUpload, IllegalRequest
+import bitfield
+from bitfield import PieceSet
+
+# Frame: kind, payload length, payload
+HEADER = struct.Struct("!BI")
+HELLO, REQUEST, REQUESTS_DONE, BLOCK, BLOCKS_DONE = range(5)
+HELLO_BODY = struct.Struct("!I")           # sender position
+# File descriptors to leave for everything else (stdio, logs, databases)
+SPARE_FDS = 32
+# The requester's own number for a request, its piece, start block and the
+# time it was sent
+REQUEST_BODY = struct.Struct("!IIdd")
+# The number of the request being answered, and how many blocks this frame
+# carries (1, or less for the tail of a fractional grant); then the data
+BLOCK_HEAD = struct.Struct("!Id")
+
+
+class LoopbackError(Exception):
+    pass
+
+
+class Conn:
+    """One end of the connection between two peers."""
+    def __init__(self, sock, remote):
+        self.sock = sock
+        self.remote = remote    # position of the peer at the other end
+        # Frames waiting to be sent.  A callable is called for its frame
+        # when the frame's turn to go comes, so it can be stamped then.
+        self.out = deque()
+        self.sent = 0           # bytes of out[0] already sent
+        self.inbuf = ""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+
+    def send_frame(self, frame):
+        self.out.append(frame)
+
+    def flush(self):
+        while self.out:
+            data = self.out[0]
+            if callable(data):
+                data = self.out[0] = data()
+            try:
+                n = self.sock.send(buffer(data, self.sent))
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.sent += n
+            if self.sent < len(data):
+                return
+            self.out.popleft()
+            self.sent = 0
+
+    def read(self):
+        """Returns the complete frames received so far, as (kind, payload)."""
+        try:
+            data = self.sock.recv(1 << 18)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+        if not data:
+            raise LoopbackError("Connection to peer %d closed" % self.remote)
+        buf = self.inbuf + data
+        frames = []
+        pos = 0
+        while len(buf) - pos >= HEADER.size:
+            (kind, length) = HEADER.unpack_from(buf, pos)
+            end = pos + HEADER.size + length
+            if end > len(buf):
+                break
+            frames.append((kind, buf[pos + HEADER.size:end]))
+            pos = end
+        self.inbuf = buf[pos:]
+        return frames
+
+
+def frame(kind, payload=""):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def recv_exactly(sock, n):
+    data = ""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise LoopbackError("Connection closed during setup")
+        data += chunk
+    return data
+
+
+class Endpoint:
+    """A peer's side of the network: its connections, its upload token
+    bucket, and what it has sent and received this round."""
+    def __init__(self, index, rate, burst):
+        """rate: upload bytes per second; burst: bucket size in bytes"""
+        self.index = index
+        self.conns = dict()     # other position -> Conn
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_fill = 0.0
+        self.paced = deque()    # (conn, frame, cost), sent as tokens allow
+
+    def start_round(self, now):
+        # Start empty, so N blocks take N / rate
+        self.tokens = 0.0
+        self.last_fill = now
+        self.incoming = []      # (requester position, its number, Request)
+        self.requests_done = 0
+        self.granted = False
+        self.asked = []         # time each of our requests went out
+                                # (None until it does)
+        self.got = dict()       # our request number -> blocks arrived
+        self.blocks_done = 0
+
+    def release(self, now):
+        """Hand queued frames to their connections as the bucket allows."""
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_fill) * self.rate)
+        self.last_fill = now
+        while self.paced and self.paced[0][2] <= self.tokens:
+            (conn, f, cost) = self.paced.popleft()
+            self.tokens -= cost
+            conn.send_frame(f)
+
+    def next_release(self):
+        """Seconds until the next queued frame can go, or None."""
+        if not self.paced:
+            return None
+        return max(0.0, (self.paced[0][2] - self.tokens) / self.rate)
+
+
+def percentiles(xs, ps=(50, 90, 99)):
+    """Nearest-rank percentiles of xs, then the max; None if xs is empty."""
+    if not xs:
+        return None
+    xs = sorted(xs)
+    ans = [xs[min(len(xs) - 1, int(len(xs) * p / 100.0))] for p in ps]
+    ans.append(xs[-1])
+    return ans
+
+
+class LoopbackStats:
+    """Network measurements, summed over every round run."""
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.agent_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.round_seconds = 0.0
+        self.rounds = 0
+        self.payload_bytes = 0
+        self.sent_blocks = dict()       # peer_id -> blocks uploaded
+        self.bw_blocks = dict()         # peer_id -> up_bw summed over rounds
+        self.message_latencies = []     # REQUEST frame delivery, seconds
+        self.block_latencies = []       # request to first block, seconds
+
+
+class LoopbackSim:
+    def __init__(self, config, block_bytes=16384, round_seconds=0.1,
+                 stall_timeout=30.0):
+        for (name, flag) in (("neighbors", "--neighbors"),
+                             ("workers", "--workers"),
+                             ("sparse_pieces", "--sparse-pieces"),
+                             ("fast_forward", "--fast-forward")):
+            if getattr(config, name):
+                raise ValueError("Loopback runs don't support %s" % flag)
+        self.config = config
+        self.block_bytes = block_bytes
+        self.round_seconds = round_seconds
+        self.stall_timeout = stall_timeout
+        self.peer_ids = peer_ids_for(config.agent_class_names)
+        self.stats = LoopbackStats()
+        check_fd_limit(len(self.peer_ids))
+
+    def connect(self, up_bws):
+        """One Endpoint per peer, fully meshed over loopback TCP."""
+        n = len(up_bws)
+        cost = HEADER.size + BLOCK_HEAD.size + self.block_bytes
+        endpoints = [Endpoint(i, bw * cost / self.round_seconds, cost)
+                     for (i, bw) in enumerate(up_bws)]
+        listeners = []
+        try:
+            for i in range(n):
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.bind(("127.0.0.1", 0))
+                s.listen(n)
+                listeners.append(s)
+            for j in range(n):
+                for i in range(j):
+                    a = socket.create_connection(listeners[j].getsockname())
+                    a.sendall(frame(HELLO, HELLO_BODY.pack(i)))
+                    (b, _) = listeners[j].accept()
+                    (kind, length) = HEADER.unpack(recv_exactly(b, HEADER.size))
+                    (who,) = HELLO_BODY.unpack(recv_exactly(b, length))
+                    if kind != HELLO or who != i:
+                        raise LoopbackError("Bad handshake from peer %d" % i)
+                    endpoints[i].conns[j] = Conn(a, j)
+                    endpoints[j].conns[i] = Conn(b, i)
+        except:
+            close(endpoints)
+            raise
+        finally:
+            for s in listeners:
+                s.close()
+        return endpoints
+
+    def run_once(self, seed=None):
+        """
+        Return a history.  A seed works as in Sim.run_sim_once: the same
+        seed gives the same bandwidths and agent random streams as the sim.
+        """
+        if seed is None:
+            return self._run_once(None)
+        saved = random.getstate()
+        random.setstate(sim_rng_state(seed))
+        try:
+            return self._run_once(seed)
+        finally:
+            random.setstate(saved)
+
+    def _run_once(self, seed):
+        conf = self.config
+        stats = self.stats
+        ids = self.peer_ids
+        n = len(ids)
+        full = conf.blocks_per_piece
+        index = dict((pid, i) for (i, pid) in enumerate(ids))
+
+        def check(lst, pred, msg, Exc):
+            for x in lst:
+                if pred(x):
+                    raise Exc(msg + " Bad element: %s" % x)
+
+        def check_requests(i, rs):
+            check(rs, lambda o: not isinstance(o, Request),
+                  "List of Requests contains non-Request object.", IllegalRequest)
+            check(rs, lambda r: r.requester_id != ids[i],
+                  "Request has wrong peer id!", IllegalRequest)
+            check(rs, lambda r: r.peer_id not in index or r.peer_id == ids[i],
+                  "Request mentions non-existent peer!", IllegalRequest)
+            check(rs, lambda r: not (0 <= r.piece_id < conf.num_pieces),
+                  "Request asks for non-existent piece!", IllegalRequest)
+            check(rs, lambda r: not (0 <= r.start < full and
+                                     r.start <= peer_pieces[i][r.piece_id]),
+                  "Request has bad start block!", IllegalRequest)
+            check(rs, lambda r: not bitfield.has(available[index[r.peer_id]],
+                                                 r.piece_id),
+                  "Asking for piece peer does not have!", IllegalRequest)
+
+        def check_uploads(i, us):
+            check(us, lambda o: not isinstance(o, Upload),
+                  "List of Uploads contains non-Upload object.", IllegalUpload)
+            check(us, lambda u: u.from_id != ids[i],
+                  "Upload.from != peer id.", IllegalUpload)
+            check(us, lambda u: u.to_id not in index or u.to_id == ids[i],
+                  "Can't upload to yourself or a non-existent peer.", IllegalUpload)
+            check(us, lambda u: u.bw < 0,
+                  "Upload bandwidth must be non-negative!", IllegalUpload)
+            if sum(u.bw for u in us) > up_bws[i]:
+                raise IllegalUpload("Can't upload more than limit of %d. %s" % (
+                    up_bws[i], us))
+
+        def call_agent(i, f, *args):
+            start = time.time()
+            try:
+                if agent_rngs is None:
+                    return f(*args)
+                return call_with_rng(agent_rngs, i, f, *args)
+            finally:
+                stats.agent_seconds += time.time() - start
+
+        padding = "\0" * self.block_bytes
+
+        def queue_blocks(ep, conn, k, blocks):
+            whole = int(blocks)
+            frames = [(1, padding)] * whole
+            if blocks > whole:
+                part = blocks - whole
+                frames.append((part, padding[:int(part * self.block_bytes)]))
+            for (amount, data) in frames:
+                f = frame(BLOCK, BLOCK_HEAD.pack(k, amount) + data)
+                ep.paced.append((conn, f, len(f)))
+
+        def grant(ep):
+            """All requests to ep are in: get its uploads and queue the
+            blocks, requester by requester, as the sim allocates them."""
+            i = ep.index
+            ep.granted = True
+            ep.incoming.sort(key=lambda t: t[0])
+            us = call_agent(i, peers[i].uploads, [r for (q, k, r) in ep.incoming],
+                            PeerView(peer_info, i), h[i])
+            check_uploads(i, us)
+            uploads[i] = us
+            left = dict()
+            for u in us:
+                left.setdefault(index[u.to_id], u.bw)
+            for (q, k, r) in ep.incoming:
+                blocks = min(left.get(q, 0), full - r.start)
+                if blocks <= 0:
+                    continue
+                left[q] -= blocks
+                queue_blocks(ep, ep.conns[q], k, blocks)
+                stats.sent_blocks[ids[i]] += blocks
+            for conn in ep.conns.values():
+                ep.paced.append((conn, frame(BLOCKS_DONE), 0))
+
+        def handle(ep, conn, kind, payload, now):
+            if kind == REQUEST:
+                (k, piece, start, sent) = REQUEST_BODY.unpack(payload)
+                stats.message_latencies.append(now - sent)
+                ep.incoming.append((conn.remote, k, Request(
+                    ids[conn.remote], ids[ep.index], piece, start)))
+            elif kind == REQUESTS_DONE:
+                ep.requests_done += 1
+                if ep.requests_done == n - 1:
+                    grant(ep)
+            elif kind == BLOCK:
+                (k, amount) = BLOCK_HEAD.unpack_from(payload)
+                if k not in ep.got:
+                    ep.got[k] = 0
+                    stats.block_latencies.append(now - ep.asked[k])
+                ep.got[k] += amount
+                stats.payload_bytes += len(payload) - BLOCK_HEAD.size
+            elif kind == BLOCKS_DONE:
+                ep.blocks_done += 1
+            else:
+                raise LoopbackError("Unknown frame kind %d" % kind)
+
+        def pump():
+            """Run the event loop until every peer has every peer's blocks."""
+            while True:
+                if all(ep.blocks_done == n - 1 for ep in endpoints):
+                    return
+                now = time.time()
+                wait = None
+                for ep in endpoints:
+                    ep.release(now)
+                    t = ep.next_release()
+                    if t is not None and (wait is None or t < wait):
+                        wait = t
+                for conn in conns.values():
+                    want = select.POLLIN
+                    if conn.out:
+                        want |= select.POLLOUT
+                    if want != registered[conn.sock.fileno()]:
+                        poller.modify(conn.sock, want)
+                        registered[conn.sock.fileno()] = want
+                if wait is None:
+                    wait = self.stall_timeout
+                start = time.time()
+                events = poller.poll(wait * 1000.0)
+                stats.wait_seconds += time.time() - start
+                if not events and not any(ep.paced for ep in endpoints):
+                    raise LoopbackError("No traffic for %.1fs" % wait)
+                now = time.time()
+                for (fd, event) in events:
+                    (ep, conn) = conns_by_fd[fd]
+                    if event & select.POLLOUT:
+                        conn.flush()
+                    if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                        for (kind, payload) in conn.read():
+                            handle(ep, conn, kind, payload, now)
+
+        def request_frame(ep, k, r):
+            """Our request k as a REQUEST frame, built, stamped and timed
+            from when it is actually written to the socket."""
+            def build():
+                sent = time.time()
+                ep.asked[k] = sent
+                return frame(REQUEST,
+                             REQUEST_BODY.pack(k, r.piece_id, r.start, sent))
+            return build
+
+        def piece_changes(i):
+            """As Sim's: (piece_id, blocks) for the pieces of peer i that
+            changed since its agent last heard, and forget them."""
+            ans = [(piece_id, peer_pieces[i][piece_id])
+                   for piece_id in sorted(set(changed[i]))]
+            changed[i] = []
+            return ans
+
+        def play_round():
+            """Returns the round's (downloads, uploads), by position."""
+            start = time.time()
+            for ep in endpoints:
+                ep.start_round(start)
+            requests = []
+            for (i, p) in enumerate(peers):
+                p.update_piece_changes(piece_changes(i))
+                rs = call_agent(i, p.requests, PeerView(peer_info, i), h[i])
+                check_requests(i, rs)
+                requests.append(rs)
+                ep = endpoints[i]
+                ep.asked = [None] * len(rs)
+                for (k, r) in enumerate(rs):
+                    ep.conns[index[r.peer_id]].send_frame(
+                        request_frame(ep, k, r))
+                for conn in ep.conns.values():
+                    conn.send_frame(frame(REQUESTS_DONE))
+                    conn.flush()
+            if n == 1:
+                grant(endpoints[0])
+            pump()
+            stats.round_seconds += time.time() - start
+            stats.rounds += 1
+            for (pid, bw) in zip(ids, up_bws):
+                stats.bw_blocks[pid] += bw
+
+            downloads = []
+            for (q, ep) in enumerate(endpoints):
+                # piece -> (blocks, from whom), as in the sim: the most
+                # blocks of a piece any one request got
+                new_blocks_per_piece = dict()
+                targets = sorted(((index[r.peer_id], k, r)
+                                  for (k, r) in enumerate(requests[q])),
+                                 key=lambda t: t[0])
+                for (peer, k, r) in targets:
+                    blocks = ep.got.get(k, 0)
+                    if blocks == 0:
+                        continue
+                    old = new_blocks_per_piece.get(r.piece_id)
+                    if old is None or blocks > old[0]:
+                        new_blocks_per_piece[r.piece_id] = (blocks, peer)
+                ds = []
+                if new_blocks_per_piece:
+                    peer_pieces[q] = copy.copy(peer_pieces[q])
+                for piece_id in new_blocks_per_piece:
+                    (blocks, peer) = new_blocks_per_piece[piece_id]
+                    peer_pieces[q][piece_id] += blocks
+                    if peer_pieces[q][piece_id] == full:
+                        available[q] |= 1 << piece_id
+                    changed[q].append(piece_id)
+                    ds.append(Download(ids[peer], ids[q], piece_id, blocks))
+                downloads.append(ds)
+            return (downloads, list(uploads))
+
+        # Same order of random draws as Sim, so seeds line up.
+        sim = Sim(conf)
+        def get_pieces(pid):
+            if pid.startswith("Seed"):
+                return [full] * conf.num_pieces
+            return [0] * conf.num_pieces
+        peer_pieces = [get_pieces(pid) for pid in ids]
+        # Per peer, the pieces that changed since its agent last saw them
+        changed = [[] for pid in ids]
+        up_bws = [sim.up_bw(pid, reinit=True) for pid in ids]
+        peers = [conf.agent_classes[name](conf, pid, get_pieces(pid), bw)
+                 for (name, pid, bw) in zip(conf.agent_class_names, ids, up_bws)]
+        history = History(ids, dict(zip(ids, up_bws)),
+                          dict((p.id, p.max_lookback) for p in peers))
+        available = [bitfield.from_pieces(
+            piece for piece in range(conf.num_pieces) if pieces[piece] == full)
+            for pieces in peer_pieces]
+        all_pieces = bitfield.full_mask(conf.num_pieces)
+        agent_rngs = None
+        if seed is not None:
+            agent_rngs = peer_rng_states(seed, n)
+        for pid in ids:
+            stats.sent_blocks.setdefault(pid, 0)
+            stats.bw_blocks.setdefault(pid, 0)
+
+        started = time.time()
+        endpoints = self.connect(up_bws)
+        try:
+            conns = dict()
+            conns_by_fd = dict()
+            registered = dict()
+            poller = select.poll()
+            for ep in endpoints:
+                for conn in ep.conns.values():
+                    fd = conn.sock.fileno()
+                    conns[fd] = conn
+                    conns_by_fd[fd] = (ep, conn)
+                    registered[fd] = select.POLLIN
+                    poller.register(conn.sock, select.POLLIN)
+
+            round = 0
+            while True:
+                logging.info("======= Round %d ========" % round)
+                peer_info = tuple(PeerInfo(p.id, PieceSet(available[i]),
+                                           available[i])
+                                  for (i, p) in enumerate(peers))
+                h = [history.peer_history(pid) for pid in ids]
+                uploads = [[] for p in peers]
+                (downloads, round_uploads) = play_round()
+                history.update(downloads, round_uploads)
+
+                done = True
+                for i in range(n):
+                    if available[i] == all_pieces:
+                        history.peer_is_done(round, ids[i])
+                    else:
+                        done = False
+                if done:
+                    logging.info("All done!")
+                    break
+                round += 1
+                if round > conf.max_round:
+                    logging.info("Out of time.  Stopping.")
+                    break
+        finally:
+            close(endpoints)
+            stats.wall_seconds += time.time() - started
+        return history
+
+    def run(self):
+        """Run config.iters iterations; returns a SimResult."""
+        c = self.config
+        histories = []
+        for i in range(c.iters):
+            seed = None
+            if c.crn_seed is not None:
+                seed = c.crn_seed + i
+            histories.append(self.run_once(seed))
+        return SimResult(self.peer_ids, histories)
+
+
+def close(endpoints):
+    for ep in endpoints:
+        for conn in ep.conns.values():
+            conn.sock.close()
+
+
+def check_fd_limit(n):
+    """Raise LoopbackError if n fully meshed peers would need more file
+    descriptors than RLIMIT_NOFILE allows."""
+    needed = n * (n - 1) + n + SPARE_FDS
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and needed > soft:
+        raise LoopbackError(
+            "%d peers need about %d file descriptors but the limit is %d; "
+            "raise it (ulimit -n) or run fewer peers" % (n, needed, soft))
+
+
+def log_network(sim):
+    s = sim.stats
+    logging.warning("======== LOOPBACK NETWORK ========")
+    if s.rounds == 0:
+        return
+    logging.warning("Rounds: %d in %.2fs (%.1f ms per round)" % (
+        s.rounds, s.wall_seconds, 1000.0 * s.round_seconds / s.rounds))
+    logging.warning("Payload: %.1f MB at %.2f MB/s" % (
+        s.payload_bytes / 1e6, s.payload_bytes / 1e6 / max(s.wall_seconds, 1e-9)))
+    logging.warning("Upload blocks/s: achieved (limit), share of up_bw granted")
+    for pid in sim.peer_ids:
+        cap = s.bw_blocks[pid] / sim.round_seconds / s.rounds
+        logging.warning("%s: %.1f  (%.1f), %.0f%%" % (
+            pid, s.sent_blocks[pid] / s.round_seconds, cap,
+            100.0 * s.sent_blocks[pid] / max(s.bw_blocks[pid], 1)))
+
+    def fmt(xs):
+        ps = percentiles(xs)
+        if ps is None:
+            return "n/a"
+        return " / ".join("%.2f" % (1000.0 * x) for x in ps)
+    logging.warning("Latency ms: p50 / p90 / p99 / max")
+    logging.warning("REQUEST delivery: %s" % fmt(s.message_latencies))
+    logging.warning("Request to first block: %s" % fmt(s.block_latencies))
+
+    loop = s.wall_seconds - s.agent_seconds - s.wait_seconds
+    def share(x):
+        return "%.2fs (%.0f%%)" % (x, 100.0 * x / max(s.wall_seconds, 1e-9))
+    logging.warning("Agents %s, waiting on sockets %s, event loop %s" % (
+        share(s.agent_seconds), share(s.wait_seconds), share(loop)))
+
+
+def main(args):
+    parser = make_option_parser()
+
+    parser.add_option("--block-bytes",
+                      dest="block_bytes", default=16384, type="int",
+                      help="Bytes of data sent per block")
+
+    parser.add_option("--round-seconds",
+                      dest="round_seconds", default=0.1, type="float",
+                      help="Wall time over which a peer may send up_bw blocks")
+
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        agents_to_run = ['Dummy', 'Dummy', 'Seed']
+    else:
+        agents_to_run = parse_agents(args)
+
+    configure_logging(options.loglevel)
+    config = make_config(options, agents_to_run)
+    sim = LoopbackSim(config, options.block_bytes, options.round_seconds)
+    result = sim.run()
+    logging.warning("All done rounds: %s" % result.all_done_rounds)
+    log_network(sim)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+"""
+Opt-in memory profiling (--mem-every N).
+
+Every N rounds the sim hands its structures and agents to
+MemoryProfiler.sample(), which walks them and charges every reachable
+object to the first part that reaches it, in this order: the history,
+the piece tables, the availability masks, then the agents, grouped by
+class.  So an object an agent keeps a reference to but the history owns
+counts as history.  The config and everything it reaches are shared by
+all agents and not charged to anyone.  Alongside that it records the
+process RSS and the number of live objects of each type (gc), and
+log_report() prints how each of those grew over the run.
+
+Sizes come from sys.getsizeof, so they are the Python objects' own sizes
+(what tracemalloc would attribute to them), not allocator overhead.
+"""
+
+import gc
+import sys
+import types
+import logging
+
+from telemetry import rss_bytes
+
+# Not followed or counted: shared code, not data
+SKIP_TYPES = (types.ModuleType, types.FunctionType, types.MethodType,
+              types.BuiltinFunctionType, type, types.ClassType)
+
+SIM_PARTS = ["history", "peer_pieces", "available"]
+
+
+def deep_size(obj, seen):
+    """Bytes of obj and everything it reaches that isn't in seen (a set of
+    ids, updated)."""
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, SKIP_TYPES):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.iterkeys())
+            stack.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset)) or \
+                type(o).__name__ == "deque":
+            stack.extend(o)
+        if hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+        for name in getattr(type(o), "__slots__", ()):
+            if hasattr(o, name):
+                stack.append(getattr(o, name))
+    return total
+
+
+def type_counts():
+    """class name -> number of live objects the gc tracks (old-style
+    instances by their own class, so Downloads and Uploads show up)"""
+    counts = dict()
+    for o in gc.get_objects():
+        if isinstance(o, types.InstanceType):
+            name = o.__class__.__name__
+        else:
+            name = type(o).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def slope(xs, ys):
+    """Least-squares slope of ys against xs, or None."""
+    n = len(xs)
+    if n < 2:
+        return None
+    mx = float(sum(xs)) / n
+    my = float(sum(ys)) / n
+    var = sum((x - mx) ** 2 for x in xs)
+    if var == 0:
+        return None
+    return sum((x - mx) * (y - my) for (x, y) in zip(xs, ys)) / var
+
+
+class MemoryProfiler:
+    def __init__(self, every):
+        self.every = every
+        self.iteration = 0
+        # (iteration, round, dict : part -> bytes, rss bytes)
+        self.samples = []
+        self.first_counts = None
+        self.last_counts = None
+
+    def due(self, round):
+        return round % self.every == 0
+
+    def sample(self, round, config, parts, peers):
+        """
+        parts: list of (name, object) for the sim's own structures, in the
+            order they get charged
+        peers: the agents
+        """
+        seen = set()
+        deep_size(config, seen)
+        sizes = dict()
+        for (name, obj) in parts:
+            sizes[name] = deep_size(obj, seen)
+        for p in peers:
+            name = "agents: %s" % p.__class__.__name__
+            sizes[name] = sizes.get(name, 0) + deep_size(p, seen)
+        self.samples.append((self.iteration, round, sizes, rss_bytes()))
+        self.last_counts = type_counts()
+        if self.first_counts is None:
+            self.first_counts = self.last_counts
+
+    def end_iteration(self):
+        self.iteration += 1
+
+    def growth(self, part):
+        """Bytes per round for part, fitted over each iteration's samples
+        and averaged; None if there aren't enough samples."""
+        slopes = []
+        for i in range(self.iteration + 1):
+            pts = [(r, sizes.get(part, 0))
+                   for (it, r, sizes, rss) in self.samples if it == i]
+            s = slope([r for (r, b) in pts], [b for (r, b) in pts])
+            if s is not None:
+                slopes.append(s)
+        if not slopes:
+            return None
+        return sum(slopes) / len(slopes)
+
+
+def fmt_bytes(n):
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024:
+            return "%.1f %s" % (n, unit)
+        n /= 1024.0
+    return "%.1f GB" % n
+
+
+def log_report(prof, top=10):
+    logging.warning("======== MEMORY ========")
+    if not prof.samples:
+        logging.warning("No samples")
+        return
+    parts = list(SIM_PARTS)
+    parts.extend(sorted(set(k for s in prof.samples for k in s[2]
+                            if k not in SIM_PARTS)))
+    first = prof.samples[0]
+    last = prof.samples[-1]
+    logging.warning("%d samples, every %d rounds" % (len(prof.samples),
+                                                      prof.every))
+    logging.warning("Retained: first / last / peak, growth per 100 rounds")
+    for part in parts:
+        sizes = [s[2].get(part, 0) for s in prof.samples]
+        g = prof.growth(part)
+        g = "n/a" if g is None else fmt_bytes(100 * g)
+        logging.warning("%s: %s / %s / %s, %s" % (
+            part, fmt_bytes(first[2].get(part, 0)), fmt_bytes(last[2].get(part, 0)),
+            fmt_bytes(max(sizes)), g))
+    logging.warning("RSS: %s / %s / %s" % (
+        fmt_bytes(first[3]), fmt_bytes(last[3]),
+        fmt_bytes(max(s[3] for s in prof.samples))))
+
+    grown = []
+    for (name, n) in prof.last_counts.items():
+        d = n - prof.first_counts.get(name, 0)
+        if d > 0:
+            grown.append((d, name, n))
+    if grown:
+        grown.sort(reverse=True)
+        logging.warning("Live objects, most grown types: +growth (now)")
+        for (d, name, n) in grown[:top]:
+            logging.warning("%s: +%d (%d)" % (name, d, n))
@@ -1,5 +1,9 @@
 #!/usr/bin/python
 
+import itertools
+
+import bitfield
+
 class Upload:
     def __init__(self, from_id, to_id, up_bw):
         self.from_id = from_id
@@ -42,11 +46,186 @@ class PeerInfo:
     """
     Only passing peer ids and the pieces they have available to each agent.
     This prevents them from accidentally messing up the state of other agents.
+
+    available_pieces: set-like collection of piece ids
+    available_mask: the same pieces as an int bitmask (bit i = piece i),
+        for fast intersection with Peer.needed_mask()
     """
-    def __init__(self, id, available):
+    def __init__(self, id, available, available_mask=None):
         self.id = id
         self.available_pieces = available
+        if available_mask is None:
+            available_mask = bitfield.from_pieces(available)
+        self.available_mask = available_mask
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
 
+
+def _as_list(x):
+    if isinstance(x, PeerView):
+        return x.copy()
+    return x
+
+
+class PeerView:
+    """
+    A read-only "everyone except me" view of one round's tuple of PeerInfo
+    objects.  All the peers share the same snapshot, so handing out a view
+    costs O(1) instead of a filtered copy of the whole list.
+
+    It supports everything a list does.  Reading (iterating, len(),
+    indexing, `in`, index(), count(), +, *, comparisons) goes straight
+    through the snapshot.  The first time an agent changes the view in
+    place (sort, reverse, random.shuffle, item assignment, append, pop,
+    remove, ...) it gets its own private list, so it can never disturb the
+    snapshot other peers see.  Call copy() to get a plain list explicitly.
+    """
+    def __init__(self, snapshot, skip=None):
+        """
+        snapshot: tuple of PeerInfo, shared by every view this round
+        skip: index into snapshot to leave out (the peer itself), or None
+        """
+        self._snapshot = snapshot
+        self._skip = skip
+        self._list = None
+
+    def _materialize(self):
+        if self._list is None:
+            self._list = self.copy()
+        return self._list
+
+    def copy(self):
+        """Return a new list with the peers in this view."""
+        if self._list is not None:
+            return self._list[:]
+        s = self._snapshot
+        if self._skip is None:
+            return list(s)
+        return list(s[:self._skip] + s[self._skip + 1:])
+
+    def __len__(self):
+        if self._list is not None:
+            return len(self._list)
+        n = len(self._snapshot)
+        if self._skip is None:
+            return n
+        return n - 1
+
+    def __iter__(self):
+        if self._list is not None:
+            return iter(self._list)
+        s = self._snapshot
+        if self._skip is None:
+            return iter(s)
+        return itertools.chain(itertools.islice(s, 0, self._skip),
+                               itertools.islice(s, self._skip + 1, None))
+
+    def __getitem__(self, i):
+        if self._list is not None:
+            return self._list[i]
+        if isinstance(i, slice):
+            return self.copy()[i]
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("PeerView index out of range")
+        if self._skip is not None and i >= self._skip:
+            i += 1
+        return self._snapshot[i]
+
+    def __getslice__(self, i, j):
+        return self[max(i, 0):max(j, 0):]
+
+    def __contains__(self, x):
+        for p in self:
+            if p == x:
+                return True
+        return False
+
+    def __reversed__(self):
+        return reversed(self._list if self._list is not None else self.copy())
+
+    def index(self, x, *args):
+        return self.copy().index(x, *args)
+
+    def count(self, x):
+        return len([p for p in self if p == x])
+
+    def __add__(self, other):
+        return self.copy() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.copy()
+
+    def __mul__(self, n):
+        return self.copy() * n
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        return self.copy() == _as_list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.copy() < _as_list(other)
+
+    def __le__(self, other):
+        return self.copy() <= _as_list(other)
+
+    def __gt__(self, other):
+        return self.copy() > _as_list(other)
+
+    def __ge__(self, other):
+        return self.copy() >= _as_list(other)
+
+    __hash__ = None
+
+    # Changes in place: on the view's own list
+
+    def __setitem__(self, i, value):
+        self._materialize()[i] = value
+
+    def __delitem__(self, i):
+        del self._materialize()[i]
+
+    def __setslice__(self, i, j, values):
+        self._materialize()[max(i, 0):max(j, 0)] = values
+
+    def __delslice__(self, i, j):
+        del self._materialize()[max(i, 0):max(j, 0)]
+
+    def __iadd__(self, other):
+        self._materialize().extend(other)
+        return self
+
+    def __imul__(self, n):
+        self._materialize()[:] = self._list * n
+        return self
+
+    def sort(self, *args, **kwargs):
+        self._materialize().sort(*args, **kwargs)
+
+    def reverse(self):
+        self._materialize().reverse()
+
+    def append(self, x):
+        self._materialize().append(x)
+
+    def extend(self, xs):
+        self._materialize().extend(xs)
+
+    def insert(self, i, x):
+        self._materialize().insert(i, x)
+
+    def pop(self, *args):
+        return self._materialize().pop(*args)
+
+    def remove(self, x):
+        self._materialize().remove(x)
+
+    def __repr__(self):
+        return "PeerView(%s)" % ", ".join(p.id for p in self)
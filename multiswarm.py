@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+
+"""
+Many swarms at once: peers that take part in several files, sharing one
+upload budget among them.
+
+There are M swarms, each one file of num_pieces pieces of
+blocks_per_piece blocks.  Every peer in the lineup joins some of them:
+the seeds are dealt out over the swarms in turn (so each swarm gets one,
+if there are enough), and every other peer joins --swarms-per-peer
+swarms picked at random.  A peer runs one agent of its class per swarm
+it joins, with the same id; each agent only sees its own swarm's peers,
+pieces and history, exactly as in a single-swarm run.
+
+A peer's up_bw is one budget for all its swarms.  Every round, once the
+requests are in, it is split (in whole blocks) over the swarms the peer
+is still active in:
+
+    demand:  in proportion to the requests the peer got in each swarm
+    even:    evenly over the swarms where the peer got any requests
+
+and each agent's up_bw is set to its swarm's share before its uploads()
+call, which must stay within it.  A swarm is finished once all its
+members have the file; its agents aren't called again and its share of
+the budget goes to the peer's other swarms.
+
+The sim keeps the state by membership: per swarm, the members' piece
+tables, availability masks and history, and per peer, the list of
+(swarm, position) it belongs to.  A round costs time in proportion to
+the (peer, swarm) memberships of the unfinished swarms, never to
+peers * swarms.
+
+    multiswarm.py [sim options] [--swarms M] [--swarms-per-peer K]
+                  [--budget-split P] PeerClass1[,count] ...
+"""
+
+import sys
+import random
+import logging
+
+from messages import Upload, Request, Download, PeerInfo, PeerView
+from history import History
+from stats import Stats
+from parallel import call_with_rng, peer_rng_states, sim_rng_state
+from sim import (Sim, configure_logging, make_config, make_option_parser,
+                 parse_agents, peer_ids_for)
+from fluid import fmt_rounds
+from util import IllegalUpload, IllegalRequest, mean
+import bitfield
+from bitfield import PieceSet
+
+POLICIES = ("demand", "even")
+
+
+def split_budget(budget, weights):
+    """
+    budget (an int) in whole blocks, in proportion to weights: the
+    remainder goes to the largest fractions, earliest first.  All zeros
+    if every weight is.
+    """
+    total = sum(weights)
+    if total == 0:
+        return [0] * len(weights)
+    exact = [float(budget) * w / total for w in weights]
+    shares = [int(x) for x in exact]
+    order = sorted(range(len(weights)), key=lambda i: shares[i] - exact[i])
+    for i in order[:budget - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+def memberships_for(peer_ids, num_swarms, per_peer):
+    """
+    The swarms each peer joins, by position: seeds are dealt out over the
+    swarms in turn, everyone else joins per_peer swarms at random (drawn
+    from the global random stream).
+    """
+    seeds = [i for (i, pid) in enumerate(peer_ids) if pid.startswith("Seed")]
+    ans = [[] for pid in peer_ids]
+    for (k, i) in enumerate(seeds):
+        ans[i] = range(k % num_swarms, num_swarms, max(len(seeds), 1))
+    for (i, pid) in enumerate(peer_ids):
+        if not pid.startswith("Seed"):
+            ans[i] = sorted(random.sample(range(num_swarms),
+                                          min(per_peer, num_swarms)))
+    return ans
+
+
+class Swarm:
+    """One file's swarm and the state of its members, by position."""
+    def __init__(self, index, members, peer_ids, up_bws, agents, pieces,
+                 available):
+        """
+        members: the peers' positions in the whole lineup
+        """
+        self.index = index
+        self.members = members
+        self.peer_ids = peer_ids
+        self.position = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.agents = agents
+        self.pieces = pieces
+        self.available = available
+        self.history = History(peer_ids, dict(zip(peer_ids, up_bws)),
+                               dict((a.id, a.max_lookback) for a in agents))
+        # Per member, the pieces that changed since its agent last saw them
+        self.changed = [[] for pid in peer_ids]
+        # Per member, its share of its peer's budget this round
+        self.shares = [0] * len(peer_ids)
+        self.done_round = None
+        # Rebuilt every round
+        self.info = None
+        self.h = None
+        self.requests_to = None
+
+
+class MultiSwarmResult:
+    """Per iteration: swarm results, and each peer's budget use."""
+    def __init__(self, peer_ids, class_names):
+        self.peer_ids = peer_ids
+        self.class_names = class_names
+        # [[(peer_id, swarm, completion round or None)]] per iteration
+        self.completion_rounds = []
+        # [[done round or None, one per swarm]] per iteration
+        self.swarm_done_rounds = []
+        # [dict : peer_id -> blocks uploaded, over all swarms]
+        self.uploaded_blocks = []
+        # [dict : peer_id -> up_bw summed over the rounds it had a swarm]
+        self.offered_blocks = []
+        self.all_done_rounds = []
+
+    def add(self, swarms, uploaded, offered):
+        completion = []
+        for sw in swarms:
+            rounds = Stats.completion_rounds(sw.peer_ids, sw.history)
+            completion.extend((pid, sw.index, rounds[pid]) for pid in sw.peer_ids)
+        self.completion_rounds.append(completion)
+        done = [sw.done_round for sw in swarms]
+        self.swarm_done_rounds.append(done)
+        self.uploaded_blocks.append(dict(zip(self.peer_ids, uploaded)))
+        self.offered_blocks.append(dict(zip(self.peer_ids, offered)))
+        self.all_done_rounds.append(None if None in done else max(done + [0]))
+
+
+class MultiSwarmSim:
+    def __init__(self, config, num_swarms, per_peer=2, policy="demand",
+                 memberships=None):
+        """
+        memberships: the swarms each peer joins, by position, instead of
+            drawing them (see memberships_for)
+        """
+        for (name, flag) in (("neighbors", "--neighbors"),
+                             ("workers", "--workers"),
+                             ("sparse_pieces", "--sparse-pieces"),
+                             ("fast_forward", "--fast-forward"),
+                             ("aggregate_seeds", "--aggregate-seeds")):
+            if getattr(config, name):
+                raise ValueError("Multi-swarm runs don't support %s" % flag)
+        if policy not in POLICIES:
+            raise ValueError("Unknown budget split %s (want one of %s)" % (
+                policy, ", ".join(POLICIES)))
+        if num_swarms < 1:
+            raise ValueError("Need at least one swarm")
+        self.config = config
+        self.num_swarms = num_swarms
+        self.per_peer = per_peer
+        self.policy = policy
+        self.memberships = memberships
+        self.peer_ids = peer_ids_for(config.agent_class_names)
+
+    def run_once(self, seed=None):
+        """
+        Returns (swarms, uploaded, offered); see MultiSwarmResult.  A seed
+        works as in Sim.run_sim_once: the bandwidths are the ones the sim
+        draws for it, and every (peer, swarm) agent gets a random stream
+        of its own.
+        """
+        if seed is None:
+            return self._run_once(None)
+        saved = random.getstate()
+        random.setstate(sim_rng_state(seed))
+        try:
+            return self._run_once(seed)
+        finally:
+            random.setstate(saved)
+
+    def _run_once(self, seed):
+        conf = self.config
+        ids = self.peer_ids
+        n = len(ids)
+        full = conf.blocks_per_piece
+        all_pieces = bitfield.full_mask(conf.num_pieces)
+
+        def check(lst, pred, msg, Exc):
+            for x in lst:
+                if pred(x):
+                    raise Exc(msg + " Bad element: %s" % x)
+
+        def check_requests(sw, i, rs):
+            me = sw.peer_ids[i]
+            check(rs, lambda o: not isinstance(o, Request),
+                  "List of Requests contains non-Request object.", IllegalRequest)
+            check(rs, lambda r: r.requester_id != me,
+                  "Request has wrong peer id!", IllegalRequest)
+            check(rs, lambda r: r.peer_id not in sw.position or r.peer_id == me,
+                  "Request mentions peer outside the swarm!", IllegalRequest)
+            check(rs, lambda r: not (0 <= r.piece_id < conf.num_pieces),
+                  "Request asks for non-existent piece!", IllegalRequest)
+            check(rs, lambda r: not (0 <= r.start < full and
+                                     r.start <= sw.pieces[i][r.piece_id]),
+                  "Request has bad start block!", IllegalRequest)
+            check(rs, lambda r: not bitfield.has(
+                      sw.available[sw.position[r.peer_id]], r.piece_id),
+                  "Asking for piece peer does not have!", IllegalRequest)
+
+        def check_uploads(sw, i, us):
+            me = sw.peer_ids[i]
+            check(us, lambda o: not isinstance(o, Upload),
+                  "List of Uploads contains non-Upload object.", IllegalUpload)
+            check(us, lambda u: u.from_id != me,
+                  "Upload.from != peer id.", IllegalUpload)
+            check(us, lambda u: u.to_id not in sw.position or u.to_id == me,
+                  "Can't upload to yourself or outside the swarm.", IllegalUpload)
+            check(us, lambda u: u.bw < 0,
+                  "Upload bandwidth must be non-negative!", IllegalUpload)
+            if sum(u.bw for u in us) > sw.shares[i]:
+                raise IllegalUpload(
+                    "Can't upload more than this swarm's share %d of %d. %s" % (
+                        sw.shares[i], up_bws[sw.members[i]], us))
+
+        def call_agent(sw, i, f, *args):
+            if agent_rngs is None:
+                return f(*args)
+            return call_with_rng(agent_rngs, offsets[sw.index] + i, f, *args)
+
+        def piece_changes(sw, i):
+            """As Sim's: (piece_id, blocks) for member i's changed pieces."""
+            pieces = sw.pieces[i]
+            ans = [(piece_id, pieces[piece_id])
+                   for piece_id in sorted(set(sw.changed[i]))]
+            sw.changed[i] = []
+            return ans
+
+        def get_requests(sw):
+            sw.info = tuple(PeerInfo(pid, PieceSet(a), a)
+                            for (pid, a) in zip(sw.peer_ids, sw.available))
+            sw.h = [sw.history.peer_history(pid) for pid in sw.peer_ids]
+            requests = []
+            for (i, agent) in enumerate(sw.agents):
+                agent.update_piece_changes(piece_changes(sw, i))
+                rs = call_agent(sw, i, agent.requests, PeerView(sw.info, i),
+                                sw.h[i])
+                check_requests(sw, i, rs)
+                requests.append(rs)
+            sw.requests_to = [[] for pid in sw.peer_ids]
+            for rs in requests:
+                for r in rs:
+                    sw.requests_to[sw.position[r.peer_id]].append(r)
+            return requests
+
+        def split(g):
+            """Share out peer g's budget over its unfinished swarms."""
+            ms = [(sw, i) for (sw, i) in mine[g] if sw.done_round is None]
+            if not ms:
+                return False
+            weights = [len(sw.requests_to[i]) for (sw, i) in ms]
+            if self.policy == "even":
+                weights = [min(w, 1) for w in weights]
+            for ((sw, i), share) in zip(ms, split_budget(up_bws[g], weights)):
+                sw.shares[i] = share
+            return True
+
+        def get_uploads(sw):
+            uploads = []
+            for (i, agent) in enumerate(sw.agents):
+                agent.up_bw = sw.shares[i]
+                us = call_agent(sw, i, agent.uploads, sw.requests_to[i],
+                                PeerView(sw.info, i), sw.h[i])
+                check_uploads(sw, i, us)
+                uploads.append(us)
+            return uploads
+
+        def update_pieces(sw, requests, uploads):
+            """
+            The sim's rule, within one swarm: each uploader's rate for a
+            requester (its first Upload to them) goes to the requester's
+            requests of it in order, and a piece asked of several peers
+            only gets the most any one of them gave.
+            """
+            rates = []
+            for us in uploads:
+                r = dict()
+                for u in us:
+                    r.setdefault(sw.position[u.to_id], u.bw)
+                rates.append(r)
+            downloads = []
+            for (q, rs) in enumerate(requests):
+                got = dict()    # piece -> (blocks, from whom)
+                targets = sorted(((sw.position[r.peer_id], r) for r in rs),
+                                 key=lambda t: t[0])
+                bw = None
+                last = None
+                for (j, r) in targets:
+                    if j != last:
+                        last = j
+                        bw = rates[j].get(q, 0)
+                    if bw == 0:
+                        continue
+                    blocks = min(bw, full - r.start)
+                    if blocks > got.get(r.piece_id, (0, None))[0]:
+                        got[r.piece_id] = (blocks, j)
+                    bw -= blocks
+                ds = []
+                pieces = sw.pieces[q]
+                for piece_id in got:
+                    (blocks, j) = got[piece_id]
+                    pieces[piece_id] += blocks
+                    if pieces[piece_id] == full:
+                        sw.available[q] |= 1 << piece_id
+                    sw.changed[q].append(piece_id)
+                    ds.append(Download(sw.peer_ids[j], sw.peer_ids[q],
+                                       piece_id, blocks))
+                    uploaded[sw.members[j]] += blocks
+                downloads.append(ds)
+            return downloads
+
+        # Same order of random draws as Sim, so seeds line up.
+        sim = Sim(conf)
+        up_bws = [sim.up_bw(pid, reinit=True) for pid in ids]
+        member_of = self.memberships
+        if member_of is None:
+            member_of = memberships_for(ids, self.num_swarms, self.per_peer)
+
+        def get_pieces(pid):
+            if pid.startswith("Seed"):
+                return [full] * conf.num_pieces
+            return [0] * conf.num_pieces
+
+        members = [[] for s in range(self.num_swarms)]
+        for (g, ss) in enumerate(member_of):
+            for s in ss:
+                members[s].append(g)
+        swarms = []
+        for (s, gs) in enumerate(members):
+            sids = [ids[g] for g in gs]
+            agents = [conf.agent_classes[conf.agent_class_names[g]](
+                          conf, ids[g], get_pieces(ids[g]), up_bws[g])
+                      for g in gs]
+            pieces = [get_pieces(pid) for pid in sids]
+            available = [bitfield.from_pieces(
+                piece for piece in range(conf.num_pieces) if p[piece] == full)
+                for p in pieces]
+            swarms.append(Swarm(s, gs, sids, [up_bws[g] for g in gs], agents,
+                                pieces, available))
+        # Per peer: (swarm, position in it) for every swarm it's in
+        mine = [[] for pid in ids]
+        offsets = []
+        total = 0
+        for sw in swarms:
+            offsets.append(total)
+            total += len(sw.members)
+            for (i, g) in enumerate(sw.members):
+                mine[g].append((sw, i))
+        agent_rngs = None
+        if seed is not None:
+            agent_rngs = peer_rng_states(seed, total)
+        uploaded = [0] * n
+        offered = [0] * n
+        logging.debug("Swarm members: %s" % [sw.peer_ids for sw in swarms])
+
+        live = [sw for sw in swarms if sw.members]
+        round = 0
+        while live:
+            logging.info("======= Round %d ========" % round)
+            requests = [get_requests(sw) for sw in live]
+            for g in range(n):
+                if split(g):
+                    offered[g] += up_bws[g]
+            for (sw, rs) in zip(live, requests):
+                uploads = get_uploads(sw)
+                downloads = update_pieces(sw, rs, uploads)
+                sw.history.update(downloads, uploads)
+                done = True
+                for (i, pid) in enumerate(sw.peer_ids):
+                    if sw.available[i] == all_pieces:
+                        sw.history.peer_is_done(round, pid)
+                    else:
+                        done = False
+                if done:
+                    sw.done_round = round
+                    logging.info("Swarm %d done" % sw.index)
+            live = [sw for sw in live if sw.done_round is None]
+            if not live:
+                logging.info("All done!")
+                break
+            round += 1
+            if round > conf.max_round:
+                logging.info("Out of time.  Stopping.")
+                break
+        return (swarms, uploaded, offered)
+
+    def run(self):
+        """Run config.iters iterations; returns a MultiSwarmResult."""
+        c = self.config
+        result = MultiSwarmResult(self.peer_ids, c.agent_class_names)
+        for i in range(c.iters):
+            seed = None
+            if c.crn_seed is not None:
+                seed = c.crn_seed + i
+            result.add(*self.run_once(seed))
+        return result
+
+
+def log_result(result, num_swarms):
+    logging.warning("======== MULTI-SWARM ========")
+    classes = dict(zip(result.peer_ids, result.class_names))
+    memberships = len(result.completion_rounds[0])
+    logging.warning("%d swarms, %d memberships (%.1f per peer)" % (
+        num_swarms, memberships, float(memberships) / len(result.peer_ids)))
+
+    logging.warning("Completion rounds per swarm joined: avg (stddev)")
+    by_class = dict()
+    for completion in result.completion_rounds:
+        for (pid, s, r) in completion:
+            by_class.setdefault(classes[pid], []).append(r)
+    for name in sorted(by_class):
+        logging.warning("%s: %s" % (name, fmt_rounds(by_class[name])))
+
+    logging.warning("Upload budget: blocks uploaded per iteration, share of budget used")
+    for name in sorted(set(result.class_names)):
+        pids = [pid for pid in result.peer_ids if classes[pid] == name]
+        up = [d[pid] for d in result.uploaded_blocks for pid in pids]
+        offered = sum(d[pid] for d in result.offered_blocks for pid in pids)
+        logging.warning("%s: %.1f, %.0f%%" % (
+            name, mean(up), 100.0 * sum(up) / max(offered, 1)))
+
+    logging.warning("Swarm done round: %s" % fmt_rounds(
+        [r for rs in result.swarm_done_rounds for r in rs]))
+    logging.warning("All done round: %s" % fmt_rounds(result.all_done_rounds))
+
+
+def main(args):
+    parser = make_option_parser()
+
+    parser.add_option("--swarms",
+                      dest="swarms", default=4, type="int",
+                      help="Number of swarms (files)")
+
+    parser.add_option("--swarms-per-peer",
+                      dest="swarms_per_peer", default=2, type="int",
+                      help="Swarms each non-seed peer joins")
+
+    parser.add_option("--budget-split",
+                      dest="budget_split", default="demand",
+                      help="How a peer's up_bw is split over its swarms: %s" % " or ".join(POLICIES))
+
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        agents_to_run = ['Dummy', 'Dummy', 'Seed']
+    else:
+        agents_to_run = parse_agents(args)
+
+    configure_logging(options.loglevel)
+    config = make_config(options, agents_to_run)
+    sim = MultiSwarmSim(config, options.swarms, options.swarms_per_peer,
+                        options.budget_split)
+    log_result(sim.run(), options.swarms)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+"""
+The sim's per-round output, formatted and written off the round loop.
+
+With --history-file or --async-output, the round loop only hands each
+round's record to an OutputWriter.  A record is a snapshot that costs
+the loop O(peers): tuples of references to the round's download and
+upload lists and piece rows, which the sim never changes once the round
+is over (it copies a piece row before changing it).  A background thread
+drains the queue in batches, turns the records into log lines and
+history file lines, and writes each batch at once.  The queue is
+bounded: when the writer falls behind, the round loop waits for room
+instead of piling up memory.  Sim waits for the queue to drain at the
+end of every run, so nothing is lost or reordered past a run's end.
+
+Agents' own logging stays synchronous, so with --async-output it can come
+out ahead of the queued lines for the same round.
+
+History file format: one JSON object per round,
+    {"run": 0, "round": 3, "downloads": [[from, to, piece, blocks], ...],
+     "uploads": [[from, to, bw], ...]}
+with runs numbered in the order they started.
+"""
+
+import json
+import Queue
+import logging
+import threading
+
+import bitfield
+from history import format_round
+
+
+def pieces_lines(peer_ids, peer_pieces):
+    return ["pieces for %s: %s" % (str(p_id), str(pieces))
+            for (p_id, pieces) in zip(peer_ids, peer_pieces)]
+
+
+def completed_line(peer_ids, available):
+    return "Pieces completed: " + ", ".join(
+        "%s:%s" % (p_id, bitfield.popcount(mask))
+        for (p_id, mask) in zip(peer_ids, available))
+
+
+class OutputWriter:
+    def __init__(self, history_path=None, log_rounds=False, maxsize=1024,
+                 batch=256):
+        """
+        history_path: write the per-round history here, or None
+        log_rounds: also log the round loop's output from the writer
+        maxsize: records the queue holds before the round loop has to wait
+        batch: records handled per write
+        """
+        self.log_rounds = log_rounds
+        self.batch = batch
+        self.queue = Queue.Queue(maxsize)
+        self.file = None
+        if history_path is not None:
+            self.file = open(history_path, "w")
+        self.runs = 0
+        self.waits = 0      # times the round loop found the queue full
+        self.error = None
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_run(self):
+        """A number for the next run's records."""
+        self.runs += 1
+        return self.runs - 1
+
+    def put(self, record):
+        if self.error is not None:
+            raise self.error
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.waits += 1
+            self.queue.put(record)
+
+    def log(self, level, msg):
+        self.put(("log", level, msg))
+
+    def round(self, run, round, peer_ids, downloads, uploads, pieces,
+              available):
+        """
+        Queue one round.  downloads, uploads: list per peer by position;
+        pieces: each peer's blocks per piece, or None if not logged;
+        available: each peer's available piece mask, or None if not logged.
+        Only the lists are copied: the rows in them must not change
+        afterwards, so the caller replaces a row rather than changing it.
+        """
+        if pieces is not None:
+            pieces = tuple(pieces)
+        if available is not None:
+            available = tuple(available)
+        self.put(("round", run, round, peer_ids, tuple(map(tuple, downloads)),
+                  tuple(map(tuple, uploads)), pieces, available))
+
+    def loop(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                if self.error is None:
+                    self.write(records)
+            except Exception, e:
+                self.error = e
+            finally:
+                for r in records:
+                    self.queue.task_done()
+            if records[-1] is None:
+                return
+
+    def write(self, records):
+        lines = []
+        log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        log_info = logging.getLogger().isEnabledFor(logging.INFO)
+        for record in records:
+            if record is None:
+                continue
+            if record[0] == "log":
+                logging.log(record[1], record[2])
+                continue
+            (_, run, round, peer_ids, downloads, uploads, pieces,
+             available) = record
+            if self.file is not None:
+                lines.append(json.dumps(dict(
+                    run=run, round=round,
+                    downloads=[[d.from_id, d.to_id, d.piece, d.blocks]
+                               for ds in downloads for d in ds],
+                    uploads=[[u.from_id, u.to_id, u.bw]
+                             for us in uploads for u in us]),
+                    separators=(",", ":")))
+                lines.append("\n")
+            if self.log_rounds:
+                if log_debug:
+                    logging.debug(format_round(round, peer_ids, downloads))
+                    if pieces is not None:
+                        for line in pieces_lines(peer_ids, pieces):
+                            logging.debug(line)
+                if log_info and available is not None:
+                    logging.info(completed_line(peer_ids, available))
+        if self.file is not None and lines:
+            self.file.write("".join(lines))
+
+    def flush(self):
+        """Wait until everything queued so far is written."""
+        self.queue.join()
+        if self.file is not None:
+            self.file.flush()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.put(None)
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+"""
+Paired comparisons of two agent lineups.
+
+Both lineups are run for the same iterations with common random numbers
+(see Sim.run_sim_once): iteration i of each uses the same seed, so the
+peer at position k gets the same bandwidth and the rest of the swarm the
+same randomness in both.  Looking at the per-iteration differences then
+cancels most of the run-to-run noise, and takes far fewer iterations to
+reach a given confidence than comparing two independent batches.
+"""
+
+import math
+import logging
+
+from stats import Stats
+from util import mean, stddev
+
+
+class PairedResult:
+    """
+    ids_a, ids_b: the peer ids at each position in the two lineups
+    completion_diffs: [[B's completion round - A's, one per iteration]]
+        per position, leaving out iterations where either didn't finish
+    uploaded_diffs: [[B's uploaded blocks - A's, one per iteration]]
+        per position
+    all_done_diffs: [B's all-done round - A's, one per iteration where
+        both finished]
+    """
+    def __init__(self, ids_a, ids_b):
+        self.ids_a = ids_a
+        self.ids_b = ids_b
+        self.completion_diffs = [[] for pid in ids_a]
+        self.uploaded_diffs = [[] for pid in ids_a]
+        self.all_done_diffs = []
+
+    def add(self, history_a, history_b):
+        done_a = Stats.completion_rounds(self.ids_a, history_a)
+        done_b = Stats.completion_rounds(self.ids_b, history_b)
+        up_a = Stats.uploaded_blocks(self.ids_a, history_a)
+        up_b = Stats.uploaded_blocks(self.ids_b, history_b)
+        for (k, (a, b)) in enumerate(zip(self.ids_a, self.ids_b)):
+            if done_a[a] is not None and done_b[b] is not None:
+                self.completion_diffs[k].append(done_b[b] - done_a[a])
+            self.uploaded_diffs[k].append(up_b[b] - up_a[a])
+        all_a = Stats.all_done_round(self.ids_a, history_a)
+        all_b = Stats.all_done_round(self.ids_b, history_b)
+        if all_a is not None and all_b is not None:
+            self.all_done_diffs.append(all_b - all_a)
+
+
+def run_paired(sim_a, sim_b, iters, base_seed):
+    """Run iteration i of both sims with seed base_seed + i."""
+    if len(sim_a.config.agent_class_names) != len(sim_b.config.agent_class_names):
+        raise ValueError("Paired lineups need the same number of peers")
+    result = None
+    for i in range(iters):
+        h_a = sim_a.run_sim_once(base_seed + i)
+        h_b = sim_b.run_sim_once(base_seed + i)
+        if result is None:
+            result = PairedResult(sim_a.peer_ids, sim_b.peer_ids)
+        result.add(h_a, h_b)
+    return result
+
+
+def summarize(diffs):
+    """mean, stddev and standard error of a list of paired differences"""
+    if len(diffs) == 0:
+        return (None, None, None)
+    sd = stddev(diffs)
+    return (mean(diffs), sd, sd / math.sqrt(len(diffs)))
+
+
+def log_paired(result):
+    def fmt(diffs):
+        (m, sd, se) = summarize(diffs)
+        if m is None:
+            return "n/a"
+        return "%+.2f  (sd %.2f, se %.2f, n=%d)" % (m, sd, se, len(diffs))
+
+    logging.warning("======== PAIRED DIFFERENCES (B - A) ========")
+    logging.warning("All done round: %s" % fmt(result.all_done_diffs))
+    logging.warning("Completion rounds: mean diff (stddev, std error)")
+    for (k, (a, b)) in enumerate(zip(result.ids_a, result.ids_b)):
+        logging.warning("%s -> %s: %s" % (a, b, fmt(result.completion_diffs[k])))
+    logging.warning("Uploaded blocks: mean diff (stddev, std error)")
+    for (k, (a, b)) in enumerate(zip(result.ids_a, result.ids_b)):
+        logging.warning("%s -> %s: %s" % (a, b, fmt(result.uploaded_diffs[k])))
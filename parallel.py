@@ -0,0 +1,224 @@
+#!/usr/bin/python
+
+"""
+Fan the request and upload phases of a round out over worker processes.
+
+Each worker owns a fixed subset of the agents for the whole simulation, so
+agent state (dummy_state, pieces, ...) stays in one place.  Every round the
+sim sends each worker the round's PeerInfo snapshot plus the inputs for its
+agents, and gets back their Requests / Uploads.  Validation stays in the
+sim.
+
+Agents use the module-level `random` functions, so every agent gets its own
+random stream, swapped into the global generator around each call.  The
+streams are seeded from the peer's position, not its worker, which makes
+the results independent of the number of workers.
+"""
+
+import random
+import traceback
+import multiprocessing
+
+from history import AgentHistory, History, ReceivedTotals, round_list
+from messages import PeerView
+
+
+def peer_rng_states(base_seed, num_peers):
+    """One independent random state per peer position."""
+    return [random.Random((base_seed << 32) | i).getstate()
+            for i in range(num_peers)]
+
+
+def sim_rng_state(base_seed):
+    """A random state for the sim's own draws, independent of every peer's
+    stream for the same base_seed."""
+    return random.Random((base_seed << 32) | 0xffffffff).getstate()
+
+
+def call_with_rng(rng_states, i, f, *args):
+    """Call f(*args) with peer i's random stream as the global one."""
+    saved = random.getstate()
+    random.setstate(rng_states[i])
+    try:
+        return f(*args)
+    finally:
+        rng_states[i] = random.getstate()
+        random.setstate(saved)
+
+
+class AgentWorker:
+    """The agents owned by one worker, and their view of the history."""
+    def __init__(self, peers, indices, rng_states):
+        """
+        peers: the agent objects this worker owns
+        indices: position of each of those peers in the round snapshot
+        rng_states: random state for each of those peers
+        """
+        self.peers = peers
+        self.indices = indices
+        self.rng_states = rng_states
+        self.past_downloads = dict((p.id, round_list(p.max_lookback))
+                                   for p in peers)
+        self.past_uploads = dict((p.id, round_list(p.max_lookback))
+                                 for p in peers)
+        self.received = dict(
+            (p.id, ReceivedTotals(History.received_window)) for p in peers)
+        self.peer_info = None
+        self.views = None
+
+    def view(self, k):
+        spec = self.views[k]
+        if spec is None:
+            return PeerView(self.peer_info, self.indices[k])
+        return PeerView(tuple(self.peer_info[j] for j in spec))
+
+    def history(self, p):
+        return AgentHistory(p.id, self.past_downloads[p.id],
+                            self.past_uploads[p.id], self.received[p.id])
+
+    def record(self, last_round):
+        """last_round: list of (downloads, uploads), one per owned peer"""
+        for (p, (ds, us)) in zip(self.peers, last_round):
+            self.past_downloads[p.id].append(ds)
+            self.past_uploads[p.id].append(us)
+            self.received[p.id].add_round(ds)
+
+    def requests(self, peer_info, views, changes, last_round):
+        """
+        peer_info: the round's tuple of PeerInfo
+        views: per owned peer, None for "everyone but me", or a tuple of
+            snapshot indices (the peer's tracker neighbors)
+        changes: per owned peer, (piece_id, blocks) for its pieces that
+            changed since the last call
+        last_round: history records from the previous round, or None
+        """
+        if last_round is not None:
+            self.record(last_round)
+        self.peer_info = peer_info
+        self.views = views
+        ans = []
+        for (k, p) in enumerate(self.peers):
+            p.update_piece_changes(changes[k])
+            ans.append(call_with_rng(self.rng_states, k, p.requests,
+                                     self.view(k), self.history(p)))
+        return ans
+
+    def uploads(self, requests):
+        """requests: per owned peer, the requests made to it this round"""
+        ans = []
+        for (k, p) in enumerate(self.peers):
+            ans.append(call_with_rng(self.rng_states, k, p.uploads,
+                                     requests[k], self.view(k),
+                                     self.history(p)))
+        return ans
+
+
+def worker_loop(conn, worker):
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        (method, args) = msg
+        try:
+            result = ("ok", getattr(worker, method)(*args))
+        except Exception:
+            result = ("error", traceback.format_exc())
+        conn.send(result)
+    conn.close()
+
+
+class WorkerError(Exception):
+    pass
+
+
+class AgentPool:
+    """
+    Runs the agents of one simulation in `num_workers` forked processes.
+    The sim's own copies of the agents go stale once the pool starts; only
+    their ids should be used afterwards.
+    """
+    def __init__(self, peers, num_workers, base_seed):
+        num_workers = max(1, min(num_workers, len(peers)))
+        states = peer_rng_states(base_seed, len(peers))
+        # Peer i belongs to worker i % num_workers
+        self.owned = [range(w, len(peers), num_workers)
+                      for w in range(num_workers)]
+        self.peer_ids = [p.id for p in peers]
+        self.conns = []
+        self.procs = []
+        for indices in self.owned:
+            worker = AgentWorker([peers[i] for i in indices], indices,
+                                 [states[i] for i in indices])
+            (parent, child) = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=worker_loop,
+                                           args=(child, worker))
+            proc.daemon = True
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+        self.last_round = None
+
+    def _call(self, method, args_for_worker):
+        for (w, conn) in enumerate(self.conns):
+            conn.send((method, args_for_worker(w)))
+        results = []
+        for conn in self.conns:
+            (status, value) = conn.recv()
+            if status != "ok":
+                raise WorkerError("Agent worker failed:\n%s" % value)
+            results.append(value)
+        return results
+
+    def _scatter(self, results):
+        """Turn per-worker result lists back into one list in peer order"""
+        ans = [None] * len(self.peer_ids)
+        for (indices, rs) in zip(self.owned, results):
+            for (i, r) in zip(indices, rs):
+                ans[i] = r
+        return ans
+
+    def requests(self, peer_info, views, changes):
+        """
+        All per-peer arguments and results are lists in peer order.
+
+        views: None or tuple of neighbor snapshot indices, per peer
+        changes: (piece_id, blocks) for each piece that changed since the
+            last call, per peer
+        Returns a list of Requests per peer
+        """
+        def args(w):
+            owned = self.owned[w]
+            last = None
+            if self.last_round is not None:
+                last = [self.last_round[i] for i in owned]
+            return (peer_info,
+                    [views[i] for i in owned],
+                    [changes[i] for i in owned],
+                    last)
+        results = self._call("requests", args)
+        self.last_round = None
+        return self._scatter(results)
+
+    def uploads(self, requests_to):
+        """
+        requests_to: list of Requests to each peer
+        Returns a list of Uploads per peer
+        """
+        results = self._call(
+            "uploads", lambda w: ([requests_to[i] for i in self.owned[w]],))
+        return self._scatter(results)
+
+    def record(self, downloads, uploads):
+        """Queue this round's history; it's shipped with the next requests."""
+        self.last_round = zip(downloads, uploads)
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except IOError:
+                pass
+            conn.close()
+        for proc in self.procs:
+            proc.join()
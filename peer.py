@@ -1,14 +1,25 @@
 #!/usr/bin/python
 
+import copy
 import random
 from messages import Upload, Request
 from util import even_split
+import bitfield
+from pieces import SparsePieces
 
 class Peer:
+    # How many past rounds of history this agent ever looks at.  None means
+    # all of them; agents that set a number get their AgentHistory kept in
+    # fixed-size windows, so long runs don't keep every round around.
+    max_lookback = None
+
     def __init__(self, config, id, init_pieces, up_bandwidth):
         self.conf = config
         self.id = id
         self.pieces = init_pieces[:]
+        self._needed_mask = None
+        # (piece_id, blocks) for the pieces that changed in the last update
+        self.last_changes = []
         # bandwidth measured in blocks-per-time-period
         self.up_bw = up_bandwidth
 
@@ -30,6 +41,73 @@ class Peer:
         so it's easy to add any extra processing...
         """
         self.pieces = new_pieces
+        self._needed_mask = None
+
+    def update_piece_changes(self, changes):
+        """
+        Called by the sim instead of update_pieces() when it knows which
+        pieces changed since this peer last looked: changes is a list of
+        (piece_id, blocks) with their new block counts, applied to
+        self.pieces in place (so don't modify self.pieces yourself).
+        needed_mask() is kept up to date as it goes, and the changes are
+        kept in self.last_changes, so an agent can keep its own per-piece
+        state in time proportional to what changed.  If a subclass
+        overrides update_pieces(), this calls it with the updated table
+        instead, as the sim used to.
+        """
+        if self.update_pieces.im_func is not Peer.update_pieces.im_func:
+            # A subclass hooks update_pieces(): hand it the whole new table.
+            pieces = copy.copy(self.pieces)
+            for (piece_id, blocks) in changes:
+                pieces[piece_id] = blocks
+            self.update_pieces(pieces)
+            self.last_changes = changes
+            return
+        full = self.conf.blocks_per_piece
+        mask = self._needed_mask
+        for (piece_id, blocks) in changes:
+            self.pieces[piece_id] = blocks
+            if mask is not None:
+                if blocks < full:
+                    mask |= 1 << piece_id
+                else:
+                    mask &= ~(1 << piece_id)
+        self._needed_mask = mask
+        self.last_changes = changes
+
+    def needed_mask(self):
+        """
+        Bitmask of the pieces this peer still needs (bit i = piece i).
+        AND it with a PeerInfo's available_mask to find what that peer can
+        give us; see bitfield.py for popcount / iter_bits.
+        """
+        if self._needed_mask is None and isinstance(self.pieces, SparsePieces):
+            self._needed_mask = self.pieces.needed_mask()
+        if self._needed_mask is None:
+            full = self.conf.blocks_per_piece
+            self._needed_mask = bitfield.from_pieces(
+                i for (i, blocks) in enumerate(self.pieces) if blocks < full)
+        return self._needed_mask
+
+    def needed_pieces(self):
+        """The ids of the pieces this peer still needs, in increasing
+        order, from needed_mask()."""
+        return bitfield.to_list(self.needed_mask())
+
+    def steady_state(self, history):
+        """
+        Called with --fast-forward after each round.  Return True if, for
+        as long as nobody finishes a piece (so every peer's available
+        pieces stay the same), this agent would keep asking for the same
+        pieces from the same peers, and keep making the same uploads,
+        round after round.  Only the start blocks of its requests move on.
+        When every agent says so, the sim skips ahead to the next piece
+        completion instead of calling them for each round in between.
+        An agent that draws random numbers each round (as the bundled ones
+        do, Seed too once several peers ask it) must not claim this:
+        skipping its calls would change what it does later.
+        """
+        return False
 
     def requests(self, peers, history):
         return []
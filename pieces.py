@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import bitfield
+
+
+class SparsePieces:
+    """
+    One peer's blocks-per-piece table, for files with a lot of pieces.
+
+    Stands in for the usual [blocks]*num_pieces list: len(), indexing,
+    iteration and item assignment all behave the same.  Underneath, complete
+    pieces are a bitmask and only pieces that are partly downloaded get a
+    dict entry, so a peer costs num_pieces / 8 bytes plus a little per
+    in-progress piece instead of a list slot per piece.
+    """
+    def __init__(self, num_pieces, blocks_per_piece, completed=0, partial=None):
+        """
+        completed: bitmask of the pieces with all their blocks
+        partial: dict : piece_id -> blocks so far, for pieces in progress
+        """
+        self.num_pieces = num_pieces
+        self.blocks_per_piece = blocks_per_piece
+        self.completed = completed
+        if partial is None:
+            partial = dict()
+        self.partial = partial
+
+    def copy(self):
+        return SparsePieces(self.num_pieces, self.blocks_per_piece,
+                            self.completed, dict(self.partial))
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def needed_mask(self):
+        """Bitmask of the pieces that still need blocks"""
+        return bitfield.full_mask(self.num_pieces) & ~self.completed
+
+    def __len__(self):
+        return self.num_pieces
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.num_pieces))]
+        if i < 0:
+            i += self.num_pieces
+        if i < 0 or i >= self.num_pieces:
+            raise IndexError("piece index out of range")
+        if bitfield.has(self.completed, i):
+            return self.blocks_per_piece
+        return self.partial.get(i, 0)
+
+    def __getslice__(self, i, j):
+        # pieces[:] is how peers copy their initial pieces
+        if i == 0 and j >= self.num_pieces:
+            return self.copy()
+        return self[slice(i, j)]
+
+    def __setitem__(self, i, blocks):
+        if i < 0:
+            i += self.num_pieces
+        if i < 0 or i >= self.num_pieces:
+            raise IndexError("piece index out of range")
+        bit = 1 << i
+        if blocks == self.blocks_per_piece:
+            self.completed |= bit
+            self.partial.pop(i, None)
+            return
+        self.completed &= ~bit
+        if blocks == 0:
+            self.partial.pop(i, None)
+        else:
+            self.partial[i] = blocks
+
+    def __iter__(self):
+        for i in xrange(self.num_pieces):
+            yield self[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "SparsePieces(complete=%d/%d, partial=%s)" % (
+            bitfield.popcount(self.completed), self.num_pieces, self.partial)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+A local SQLite database of per-iteration results, for comparing many
+runs without grepping logs.
+
+    configs:       one row per distinct config (by hash), with the lineup's
+                   size and number of seeds
+    runs:          one row per iteration: its config, seed and all done round
+    peer_results:  one row per peer per iteration: agent class, bandwidth,
+                   blocks uploaded and completion round (NULL if unfinished)
+
+peer_results carries its config id too, and is indexed on it and on the
+agent class, so per-class summaries stay fast over millions of rows.
+Each add() is one transaction.
+
+sim.py --results-db PATH (or simulate() with a results_db key) adds every
+iteration to PATH as it finishes.  A process keeps one connection per
+path (see shared()), so sweeps of many simulate() calls only set it up
+once.  To summarize:
+
+    resultsdb.py PATH [--class AgentClass]
+
+prints, per config and agent class, the mean completion round and blocks
+uploaded.
+"""
+
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+from optparse import OptionParser
+
+# The config options that change what a run does.  Everything else
+# (iters, crn_seed, workers, logging, telemetry, ...) leaves the config's
+# hash alone, so runs of the same setup land together.
+OUTCOME_KEYS = ["num_pieces", "blocks_per_piece", "max_round", "min_up_bw",
+                "max_up_bw", "neighbors", "neighbor_refresh",
+                "aggregate_seeds"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS configs (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    config TEXT NOT NULL,
+    num_peers INTEGER NOT NULL,
+    num_seeds INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    config_id INTEGER NOT NULL REFERENCES configs(id),
+    iteration INTEGER NOT NULL,
+    seed INTEGER,
+    all_done_round INTEGER,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS peer_results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    config_id INTEGER NOT NULL REFERENCES configs(id),
+    peer_id TEXT NOT NULL,
+    agent_class TEXT NOT NULL,
+    up_bw INTEGER NOT NULL,
+    uploaded REAL NOT NULL,
+    completion_round INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_config ON runs(config_id);
+CREATE INDEX IF NOT EXISTS peer_results_config ON peer_results(config_id);
+CREATE INDEX IF NOT EXISTS peer_results_class
+    ON peer_results(agent_class, config_id);
+"""
+
+
+def config_dict(config):
+    """The outcome-relevant part of sim Params, plus the lineup."""
+    d = dict((k, getattr(config, k)) for k in OUTCOME_KEYS if hasattr(config, k))
+    d["agents"] = list(config.agent_class_names)
+    return d
+
+
+def config_hash(d):
+    return hashlib.sha1(json.dumps(d, sort_keys=True)).hexdigest()
+
+
+class ResultsDB:
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        # config hash -> configs.id, for configs seen through this connection
+        self.config_ids = dict()
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        # Several processes may write to the same file.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def config_id(self, d):
+        h = config_hash(d)
+        if h in self.config_ids:
+            return self.config_ids[h]
+        row = self.conn.execute("SELECT id FROM configs WHERE hash = ?",
+                                (h,)).fetchone()
+        if row is None:
+            agents = d["agents"]
+            self.conn.execute(
+                "INSERT OR IGNORE INTO configs (hash, config, num_peers, num_seeds) "
+                "VALUES (?, ?, ?, ?)",
+                (h, json.dumps(d, sort_keys=True), len(agents),
+                 len([a for a in agents if a == "Seed"])))
+            row = self.conn.execute("SELECT id FROM configs WHERE hash = ?",
+                                    (h,)).fetchone()
+        self.config_ids[h] = row[0]
+        return row[0]
+
+    def add(self, config, result, seeds=None, first_iteration=0):
+        """
+        Add every iteration of a SimResult for the given sim Params, in one
+        transaction.  seeds: the seed of each iteration, if known;
+        first_iteration: the number of the result's first iteration.
+        """
+        d = config_dict(config)
+        classes = dict(zip(result.peer_ids, config.agent_class_names))
+        if seeds is None:
+            seeds = [None] * len(result.all_done_rounds)
+        now = time.time()
+        with self.conn:
+            config_id = self.config_id(d)
+            for (i, seed) in enumerate(seeds):
+                cur = self.conn.execute(
+                    "INSERT INTO runs (config_id, iteration, seed, "
+                    "all_done_round, created) VALUES (?, ?, ?, ?, ?)",
+                    (config_id, first_iteration + i, seed,
+                     result.all_done_rounds[i], now))
+                run_id = cur.lastrowid
+                bws = result.upload_rates[i]
+                uploaded = result.uploaded_blocks[i]
+                rounds = result.completion_rounds[i]
+                self.conn.executemany(
+                    "INSERT INTO peer_results (run_id, config_id, peer_id, "
+                    "agent_class, up_bw, uploaded, completion_round) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(run_id, config_id, pid, classes[pid], bws[pid],
+                      uploaded[pid], rounds[pid]) for pid in result.peer_ids])
+
+    def class_means(self, agent_class=None):
+        """
+        Per config and agent class: (config hash, num_peers, num_seeds,
+        agent class, peer results, mean completion round over the finished
+        ones, unfinished count, mean blocks uploaded).
+        """
+        where = ""
+        args = ()
+        if agent_class is not None:
+            where = "WHERE r.agent_class = ?"
+            args = (agent_class,)
+        return self.conn.execute(
+            "SELECT c.hash, c.num_peers, c.num_seeds, r.agent_class, "
+            "COUNT(*), AVG(r.completion_round), "
+            "SUM(r.completion_round IS NULL), AVG(r.uploaded) "
+            "FROM peer_results r JOIN configs c ON c.id = r.config_id "
+            "%s GROUP BY r.config_id, r.agent_class "
+            "ORDER BY c.num_seeds * 1.0 / c.num_peers, c.hash, r.agent_class"
+            % where, args).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+# path -> ResultsDB, one per process
+_shared = dict()
+
+def shared(path):
+    """This process's connection to the database at path, opened (and
+    the schema set up) on first use and kept open."""
+    if path not in _shared:
+        _shared[path] = ResultsDB(path)
+    return _shared[path]
+
+
+def main(args):
+    parser = OptionParser(usage="Usage:  %prog DB [--class AgentClass]")
+    parser.add_option("--class",
+                      dest="agent_class", default=None,
+                      help="Only this agent class")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    db = ResultsDB(args[0])
+    try:
+        print "config        seeds/peers  class                results  completion  (unfinished)  uploaded"
+        for (h, peers, seeds, cls, n, completion, unfinished, uploaded) in \
+                db.class_means(options.agent_class):
+            if completion is None:
+                completion = "never"
+            else:
+                completion = "%.2f" % completion
+            print "%-12s  %5d/%-5d  %-20s %7d  %10s  (%d)  %12.1f" % (
+                h[:12], seeds, peers, cls, n, completion, unfinished, uploaded)
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
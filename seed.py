@@ -6,6 +6,15 @@ from util import even_split
 from peer import Peer
 
 class Seed(Peer):
+    # Seeds never look at their history
+    max_lookback = 0
+
+    def post_init(self):
+        self.steady = True
+
+    def steady_state(self, history):
+        return self.steady
+
     def requests(self, peers, history):
         # Seeds don't need anything.
         return []
@@ -16,9 +25,49 @@ class Seed(Peer):
 
         n = min(max_upload, len(requester_ids))
         if n == 0:
+            self.steady = True
             return []
         bws = even_split(self.up_bw, n)
         uploads = [Upload(self.id, p_id, bw)
-                   for (p_id, bw) in zip(random.sample(requester_ids, n), bws)]
+                   for (p_id, bw) in zip(pick(requester_ids, n), bws)]
+        # Several requesters go in a random order, which a skipped round
+        # would neither repeat nor draw for.
+        self.steady = len(requester_ids) == 1
         
         return uploads
+
+
+def pick(requester_ids, n):
+    """n of requester_ids in a random order; a lone requester needs no
+    random draw."""
+    if len(requester_ids) == 1:
+        return requester_ids
+    return random.sample(requester_ids, n)
+
+
+def batch_uploads(seeds, requests):
+    """
+    Seed.uploads for a group of seeds in one call, as the sim does with
+    --aggregate-seeds.  seeds: Seed agents; requests: the requests made to
+    each.  Returns a list of Uploads per seed.  Each seed picks and splits
+    just as Seed.uploads would; seeds nobody asked cost nothing, and the
+    even splits are only worked out once per bandwidth.
+    """
+    max_upload = 4
+    splits = dict()   # (up_bw, n) -> bws
+    ans = []
+    for (s, rs) in zip(seeds, requests):
+        if not rs:
+            s.steady = True
+            ans.append([])
+            continue
+        requester_ids = list(set([r.requester_id for r in rs]))
+        n = min(max_upload, len(requester_ids))
+        key = (s.up_bw, n)
+        if key not in splits:
+            splits[key] = even_split(s.up_bw, n)
+        bws = splits[key]
+        s.steady = len(requester_ids) == 1
+        ans.append([Upload(s.id, p_id, bw)
+                    for (p_id, bw) in zip(pick(requester_ids, n), bws)])
+    return ans
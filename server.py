@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+Long-lived simulation server.  Keeps a pool of warm worker processes with
+the agent modules already imported, and runs one simulation per JSON line.
+
+Each request is a JSON object on one line:
+
+    {"id": 7, "agents": ["Dummy,2", "Seed"], "num_pieces": 10, "seed": 3}
+
+"agents" uses the same Class[,count] syntax as sim.py.  Every other key is
+one of sim.py's options, by its dest name:
+
+    num_pieces, blocks_per_piece, max_round, min_up_bw, max_up_bw, iters,
+    neighbors, neighbor_refresh, sparse_pieces, crn_seed, aggregate_seeds,
+    fast_forward, mem_every, results_db, history_file, async_output,
+    output_queue, metrics_file, metrics_port, metrics_interval,
+    trace_file, trace_every, trace_buffer
+
+anything left out gets sim.py's default.  loglevel and paired are
+command-line only, and workers is refused here (pool workers can't start
+their own).  "seed" seeds the random number generator for that request,
+and "id" is echoed back.
+
+Each response is one JSON line:
+
+    {"id": 7, "peers": [...], "bw": [[...]], "uploaded": [[...]],
+     "rounds": [[...]]}
+
+with one inner list per iteration, in the order of "peers".  "rounds" holds
+each peer's completion round (null if it never finished).  On failure the
+response is {"id": ..., "error": "..."}.
+
+Requests come from stdin (responses go to stdout, in request order), or
+from a Unix socket with --socket PATH (responses go back on the same
+connection).
+"""
+
+import os
+import sys
+import json
+import logging
+import traceback
+import multiprocessing
+import SocketServer
+from optparse import OptionParser
+
+from sim import configure_logging, simulate
+from util import load_modules
+
+
+def init_worker(loglevel, preload):
+    # Agents print from post_init(); keep that off the response stream.
+    sys.stdout = sys.stderr
+    configure_logging(loglevel, sys.stderr)
+    load_modules(preload)
+
+
+def run_request(line):
+    """Run one JSON request line; return one JSON response line."""
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.pop("id", None)
+        seed = request.pop("seed", None)
+        # Pool workers are daemons, which can't start an AgentPool.
+        if request.get("workers", 0) > 0:
+            raise ValueError("workers isn't supported in server mode")
+        result = simulate(request, seed).as_dict()
+        result["id"] = request_id
+    except Exception, e:
+        logging.debug(traceback.format_exc())
+        result = dict(id=request_id, error="%s: %s" % (e.__class__.__name__, e))
+    return json.dumps(result, separators=(",", ":"))
+
+
+def request_lines(f):
+    for line in iter(f.readline, ""):
+        if line.strip():
+            yield line
+
+
+def serve_stdin(pool):
+    out = sys.stdout
+    for response in pool.imap(run_request, request_lines(sys.stdin)):
+        out.write(response + "\n")
+        out.flush()
+
+
+def serve_socket(pool, path):
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            for line in request_lines(self.rfile):
+                self.wfile.write(pool.apply(run_request, (line,)) + "\n")
+                self.wfile.flush()
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = Server(path, Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def main(args):
+    parser = OptionParser(usage="Usage:  %prog [options]")
+
+    parser.add_option("--socket",
+                      dest="socket", default=None,
+                      help="Listen on this Unix socket instead of stdin")
+
+    parser.add_option("--procs",
+                      dest="procs", default=multiprocessing.cpu_count(),
+                      type="int",
+                      help="Number of warm worker processes")
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Logging level for the sims (logged to stderr)")
+
+    parser.add_option("--preload",
+                      dest="preload", default="Seed,Dummy",
+                      help="Comma-separated agent classes to import up front")
+
+    (options, args) = parser.parse_args()
+
+    preload = [c for c in options.preload.split(",") if c]
+    configure_logging(options.loglevel, sys.stderr)
+    pool = multiprocessing.Pool(options.procs, init_worker,
+                                (options.loglevel, preload))
+    try:
+        if options.socket is None:
+            serve_stdin(pool)
+        else:
+            serve_socket(pool, options.socket)
+    finally:
+        pool.terminate()
+        pool.join()
+
+if __name__ == "__main__":
+    main(sys.argv)
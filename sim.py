@@ -17,16 +17,77 @@ import itertools
 import pprint
 from optparse import OptionParser
 
-from messages import Upload, Request, Download, PeerInfo
+from messages import Upload, Request, Download, PeerInfo, PeerView
 from util import *
 from stats import Stats
+from paired import run_paired, log_paired
 from history import History
+from tracker import Tracker
+from parallel import AgentPool, call_with_rng, peer_rng_states, sim_rng_state
+import bitfield
+from bitfield import PieceSet
+from pieces import SparsePieces
+from seed import Seed, batch_uploads
+from telemetry import Telemetry
+from memprof import MemoryProfiler, log_report
+import resultsdb
+from output import OutputWriter, pieces_lines, completed_line
+from timeline import Tracer
     
 
+class SimState:
+    """
+    A run paused at the start of a round, as handed to Sim.fork_hook.
+    Changes made to the agents, piece tables or config carry on into the
+    rest of the run.
+
+    peers, peer_pieces, available, up_bws: per-peer lists in position order
+    history: the History so far
+    """
+    def __init__(self, config, round, peers, peer_pieces, available, up_bws,
+                 history):
+        self.config = config
+        self.round = round
+        self.peers = peers
+        self.peer_pieces = peer_pieces
+        self.available = available
+        self.up_bws = up_bws
+        self.history = history
+        self.peer_ids = [p.id for p in peers]
+
+    def replace_agent(self, peer_id, agent_class):
+        """
+        Swap the agent playing peer_id for a fresh agent_class, keeping the
+        id, pieces and bandwidth.  The new agent sees the old one's history,
+        kept as far back as the old one asked for (see Peer.max_lookback)
+        or as Sim.min_lookbacks says.
+        """
+        i = self.peer_ids.index(peer_id)
+        self.peers[i] = agent_class(self.config, peer_id,
+                                    self.peer_pieces[i], self.up_bws[i])
+
+
 class Sim:
     def __init__(self, config):
         self.config = config
         self.up_bws_state = dict()
+        self.telemetry = None
+        # Tracer, with --trace-file
+        self.tracer = None
+        # MemoryProfiler, with --mem-every
+        self.memory = None
+        # OutputWriter, with --history-file or --async-output
+        self.output = None
+        # (round, f): call f(SimState) at the start of that round
+        self.fork_hook = None
+        # peer_id -> rounds of history to keep at least (None = all), for
+        # agents that fork_hook may swap in
+        self.min_lookbacks = dict()
+        # ResultsDB the iterations go to, if any
+        self.results_db = None
+        # Keep every round in the History, even for agents with a
+        # max_lookback (logging at INFO does too)
+        self.full_history = False
 
     
     def up_bw(self, peer_id, reinit=False):
@@ -44,8 +105,27 @@ class Sim:
         
         return s.setdefault(peer_id, the_up_bw)
 
-    def run_sim_once(self):
-        """Return a history"""
+    def run_sim_once(self, seed=None):
+        """
+        Return a history.
+
+        With a seed, the run uses common random numbers: the sim's own draws
+        (bandwidths, tracker) come from one stream seeded with it, and every
+        agent gets its own stream seeded with it and the agent's position.
+        Two configs that only differ in which strategy sits at a position
+        then see the same bandwidths and the same randomness elsewhere.  The
+        global random state is left as it was.
+        """
+        if seed is None:
+            return self._run_sim_once(None)
+        saved = random.getstate()
+        random.setstate(sim_rng_state(seed))
+        try:
+            return self._run_sim_once(seed)
+        finally:
+            random.setstate(saved)
+
+    def _run_sim_once(self, seed):
         conf = self.config
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0  
@@ -59,7 +139,7 @@ class Sim:
                 i = m.index(True)
                 raise Exc(msg + " Bad element: %s" % lst[i])
 
-        def check_uploads(peer, uploads):
+        def check_uploads(i, peer, uploads):
             """Raise an IllegalUpload exception if there is a problem."""
             def check(pred, msg):
                 check_pred(pred, msg, IllegalUpload, uploads)
@@ -75,14 +155,18 @@ class Sim:
 
             check(lambda u: u.bw < 0, "Upload bandwidth must be non-negative!")
 
-            limit = self.up_bw(peer.id)
+            if tracker is not None:
+                not_neighbor = lambda u: not tracker.are_neighbors(peer.id, u.to_id)
+                check(not_neighbor, "Can't upload to a non-neighbor peer.")
+
+            limit = up_bws[i]
             if sum(map(lambda u: u.bw, uploads)) > limit:
                 raise IllegalUpload("Can't upload more than limit of %d. %s" % (
                     limit, uploads))
 
             # If we got here, looks ok.
 
-        def check_requests(peer, requests, peer_pieces, available):
+        def check_requests(i, peer, requests, peer_pieces, available):
             """Raise an IllegalRequest exception if there is a problem."""
 
             def check(pred, msg):
@@ -95,46 +179,49 @@ class Sim:
                                       r.piece_id >= self.config.num_pieces)
             check(bad_piece_id, "Request asks for non-existent piece!")
             
-            bad_peer_id = lambda r: r.peer_id not in self.peer_ids
+            bad_peer_id = lambda r: r.peer_id not in peer_index
             check(bad_peer_id, "Request mentions non-existent peer!")
 
+            if tracker is not None:
+                not_neighbor = lambda r: not tracker.are_neighbors(peer.id, r.peer_id)
+                check(not_neighbor, "Request mentions non-neighbor peer!")
+
             bad_requester_id = lambda r: r.requester_id != peer.id
             check(bad_requester_id, "Request has wrong peer id!")
 
             bad_start_block = lambda r: (
                 r.start < 0 or
                 r.start >= self.config.blocks_per_piece or
-                r.start > peer_pieces[peer.id][r.piece_id])
+                r.start > peer_pieces[i][r.piece_id])
             # Must request the _next_ necessary block
             check(bad_start_block, "Request has bad start block!")
 
             def piece_peer_does_not_have(r):
-                other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
+                return not bitfield.has(available[peer_index[r.peer_id]],
+                                        r.piece_id)
             check(piece_peer_does_not_have, "Asking for piece peer does not have!")
             
             # If we got here, looks ok
 
-        def available_pieces(peer_id, peer_pieces):
+        def available_pieces(i, peer_pieces):
             """
-            Return a list of piece ids that this peer has available.
+            Return a list of piece ids that peer i has available.
             """
-            return filter(lambda i: peer_pieces[peer_id][i] == conf.blocks_per_piece,
+            return filter(lambda piece: peer_pieces[i][piece] == conf.blocks_per_piece,
                           range(conf.num_pieces))
 
-        def peer_done(peer_pieces, peer_id):
-            # TODO: remove linear pass
-            for blocks_so_far in peer_pieces[peer_id]:
-                if blocks_so_far < conf.blocks_per_piece:
-                    return False
-            return True
+        all_pieces = bitfield.full_mask(conf.num_pieces)
+
+        def peer_done(available, i):
+            # A piece is available exactly when all its blocks are in.
+            return available[i] == all_pieces
             
-        def all_done(peer_pieces):
+        def all_done(available):
             result = True
             # Check all peers to update done status
-            for peer_id in peer_pieces:
-                if peer_done(peer_pieces, peer_id):
-                    history.peer_is_done(round, peer_id)
+            for i in range(len(available)):
+                if peer_done(available, i):
+                    history.peer_is_done(round, self.peer_ids[i])
                 else:
                     result = False
             return result
@@ -148,29 +235,24 @@ class Sim:
                 agent_class = conf.agent_classes[class_name]
                 return agent_class(*params)
 
-            counts = dict()
-            def index(name):
-                if name in counts:
-                    a = counts[name]
-                    counts[name] += 1
-                else:
-                    a = 0
-                    counts[name] = 1
-                return a
-
-            n = len(conf.agent_class_names)
-            ids = map(lambda n: "%s%d" % (n,index(n)), conf.agent_class_names)
+            ids = peer_ids_for(conf.agent_class_names)
 
             is_seed = lambda id: id.startswith("Seed")
 
             def get_pieces(id):
+                if conf.sparse_pieces:
+                    completed = 0
+                    if id.startswith("Seed"):
+                        completed = all_pieces
+                    return SparsePieces(conf.num_pieces, conf.blocks_per_piece,
+                                        completed)
                 if id.startswith("Seed"):
                     return [conf.blocks_per_piece]*conf.num_pieces
                 else:
                     return [0]*conf.num_pieces
                 
-            peer_pieces = dict()  # id -> list (blocks / piece)
-            peer_pieces = dict((id, get_pieces(id)) for id in ids)
+            # Blocks per piece, one list per peer by position
+            peer_pieces = [get_pieces(id) for id in ids]
             pieces = [get_pieces(id) for id in ids]
             r = itertools.repeat
             
@@ -180,49 +262,127 @@ class Sim:
             params = zip(r(conf), ids, pieces, up_bws)
 
             peers = map(load, conf.agent_class_names, params)
+            if conf.aggregate_seeds:
+                # Seeds never change their pieces, so they can all share
+                # one table, in the sim and in the agents.
+                shared = None
+                for (i, p) in enumerate(peers):
+                    if p.__class__ is Seed:
+                        if shared is None:
+                            shared = peer_pieces[i]
+                        peer_pieces[i] = shared
+                        p.pieces = shared
             #logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
-            return peers, peer_pieces
-
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return filter(lambda peer: peer.id != p.id, peer_info)
-
-            pieces = copy.copy(peer_pieces[p.id])
-            # Made copy of pieces and the peer info this peer needs to make it's
-            # decision, so that it can't change the simulation's copies.
-            p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
-            return rs
-
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return filter(lambda peer: peer.id != p.id, peer_info)
+            return peers, peer_pieces, up_bws
 
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in all_requests.values():
-                    ans.extend(filter(f, rs))
-                return ans
-
-            requests = requests_to(p.id)
+        def peer_view(i, peer_info):
+            """
+            The other peers peer i can see this round: a fresh copy-on-write
+            view over the shared snapshot, so agents that sort or shuffle it
+            in place only pay for a copy when they do.
+            """
+            if tracker is not None:
+                return PeerView(tuple(peer_info[peer_index[n]] for n in
+                                      tracker.neighbors_of(self.peer_ids[i])))
+            return PeerView(peer_info, i)
+
+        def view_spec(i):
+            """peer_view() in a form that can be shipped to a worker"""
+            if tracker is not None:
+                return tuple(peer_index[n] for n in
+                             tracker.neighbors_of(self.peer_ids[i]))
+            return None
+
+        def call_agent(i, f, *args):
+            """Call one of peer i's methods, on its own random stream if it
+            has one."""
+            if trace is not None and trace.sampled:
+                start = trace.now()
+                try:
+                    return call_untraced(i, f, *args)
+                finally:
+                    trace.agent(i, f.__name__, start)
+            return call_untraced(i, f, *args)
+
+        def call_untraced(i, f, *args):
+            if agent_rngs is None:
+                return f(*args)
+            return call_with_rng(agent_rngs, i, f, *args)
+
+        def mark(phase):
+            """The current phase of the round is over."""
+            if telemetry is not None:
+                telemetry.mark(phase)
+            if trace is not None:
+                trace.mark(phase)
+
+        def piece_changes(i):
+            """(piece_id, blocks) for the pieces of peer i that changed
+            since its agent last heard, and forget them."""
+            ans = [(piece_id, peer_pieces[i][piece_id])
+                   for piece_id in sorted(set(changed[i]))]
+            changed[i] = []
+            return ans
+
+        def get_peer_requests(i, p, peer_info, peer_history, peer_pieces, available):
+
+            # The agent keeps its own copy of its pieces; it only gets
+            # told what changed, so it can't change the simulation's copies.
+            p.update_piece_changes(piece_changes(i))
+            rs = call_agent(i, p.requests, peer_view(i, peer_info), peer_history)
+            check_requests(i, p, rs, peer_pieces, available)
+            return rs
 
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
-            check_uploads(p, us)
+        def seed_group():
+            """Positions of the plain Seeds, handled together with
+            --aggregate-seeds (in-process agents only)."""
+            if not conf.aggregate_seeds or conf.workers > 0:
+                return []
+            return [i for (i, p) in enumerate(peers) if p.__class__ is Seed]
+
+        def get_seed_uploads(requests_to, uploads):
+            """One batched call for all the grouped seeds, drawing from the
+            first one's random stream."""
+            us = call_agent(seeds[0], batch_uploads, [peers[i] for i in seeds],
+                            [requests_to[i] for i in seeds])
+            for (i, u) in zip(seeds, us):
+                check_uploads(i, peers[i], u)
+                uploads[i] = u
+
+        def get_peer_uploads(requests_to, i, p, peer_info, peer_history):
+            requests = requests_to[i]
+
+            us = call_agent(i, p.uploads, requests, peer_view(i, peer_info),
+                            peer_history)
+            check_uploads(i, p, us)
             return us
 
-        def upload_rate(uploads, uploader_id, requester_id):
+        def requests_by_target(all_requests):
             """
-            return the uploading rate from uploader to requester
-            in blocks per time period, or 0 if not uploading.
+            Index this round's requests by the position of the peer being
+            asked, so each uploader only sees its own requests instead of
+            rescanning all of them.  Each target gets its requests in
+            requester order.
             """
-            for u in uploads[uploader_id]:
-                if u.to_id == requester_id:
-                    return u.bw
-            return 0
+            ans = [[] for p in peers]
+            for rs in all_requests:
+                for r in rs:
+                    ans[peer_index[r.peer_id]].append(r)
+            return ans
+
+        def rates_by_requester(uploads):
+            """
+            Per uploader position: dict : requester position -> the rate
+            it uploads to that requester at, in blocks per time period.  If
+            an agent lists the same requester twice, the first one counts.
+            """
+            ans = []
+            for us in uploads:
+                rates = dict()
+                for u in us:
+                    rates.setdefault(peer_index[u.to_id], u.bw)
+                ans.append(rates)
+            return ans
 
         def update_peer_pieces(peer_pieces, requests, uploads, available):
             """
@@ -230,123 +390,421 @@ class Sim:
             pieces the requesters ended up with.
             Make sure requesting the same thing from lots of peers doesn't
             stack.
-            update the sets of available pieces as needed.
+            update the available piece bitmasks as needed.
             """
-            downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
-            for requester_id in requests:
-                downloads[requester_id] = list()
-            for requester_id in requests:
+            rates = rates_by_requester(uploads)
+            ids = self.peer_ids
+            # [downloads], one list per peer by position
+            downloads = [[] for p in peers]
+            # Only the rows of peers that get blocks are copied; everyone
+            # else shares their row with the old peer_pieces.
+            new_pp = list(peer_pieces)
+            for q in range(len(requests)):
                 # Keep track of how many blocks of each piece this
                 # requester got.  piece -> (blocks, from_who)
                 new_blocks_per_piece = dict()
-                def update_count(piece_id, blocks, peer_id):
+                def update_count(piece_id, blocks, peer):
                     if piece_id in new_blocks_per_piece:
                         old = new_blocks_per_piece[piece_id][0]
                         if blocks > old:
-                            new_blocks_per_piece[piece_id] = (blocks, peer_id)
+                            new_blocks_per_piece[piece_id] = (blocks, peer)
                     else:
-                        new_blocks_per_piece[piece_id] = (blocks, peer_id)
+                        new_blocks_per_piece[piece_id] = (blocks, peer)
 
                 # Group the requests by peer that is being asked
-                get_peer_id = lambda r: r.peer_id
-                rs = sorted(requests[requester_id], key=get_peer_id)
-                for peer_id, rs_for_peer in itertools.groupby(rs, get_peer_id):
-                    bw = upload_rate(uploads, peer_id, requester_id)
+                targets = [(peer_index[r.peer_id], r) for r in requests[q]]
+                targets.sort(key=lambda t: t[0])
+                for peer, ts_for_peer in itertools.groupby(targets, lambda t: t[0]):
+                    bw = rates[peer].get(q, 0)
                     if bw == 0:
                         continue
                     # This bandwidth gets applied in order to each piece requested
-                    for r in rs_for_peer:
+                    for (_, r) in ts_for_peer:
                         needed_blocks = conf.blocks_per_piece - r.start
                         alloced_bw = min(bw, needed_blocks)
-                        update_count(r.piece_id, alloced_bw, peer_id)
+                        update_count(r.piece_id, alloced_bw, peer)
                         bw -= alloced_bw
                         if bw == 0:
                             break
+                if new_blocks_per_piece:
+                    new_pp[q] = copy.copy(peer_pieces[q])
                 for piece_id in new_blocks_per_piece:
-                    (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
-                    d = Download(peer_id, requester_id, piece_id, blocks)
-                    downloads[requester_id].append(d)
+                    (blocks, peer) = new_blocks_per_piece[piece_id]
+                    new_pp[q][piece_id] += blocks
+                    if new_pp[q][piece_id] == conf.blocks_per_piece:
+                        available[q] |= 1 << piece_id
+                    d = Download(ids[peer], ids[q], piece_id, blocks)
+                    downloads[q].append(d)
                 
             return (new_pp, downloads)
 
-        def completed_pieces(peer_id, available):
-            return len(available[peer_id])
-        
+        def steady_rounds(peer_info, downloads, h):
+            """
+            How many of the coming rounds are sure to repeat this one's
+            downloads: 0 unless every agent says it's in a steady state and
+            nothing finished this round, otherwise up to the round before
+            the next piece would complete (or the tracker re-announce, or
+            max_round).
+            """
+            for (i, info) in enumerate(peer_info):
+                if available[i] != info.available_mask:
+                    return 0
+            for (i, p) in enumerate(peers):
+                if not p.steady_state(h[i]):
+                    return 0
+            k = conf.max_round - round
+            if self.fork_hook is not None and self.fork_hook[0] > round:
+                k = min(k, self.fork_hook[0] - round - 1)
+            if tracker is not None and tracker.refresh > 0:
+                next_refresh = (round // tracker.refresh + 1) * tracker.refresh
+                k = min(k, next_refresh - round - 1)
+            for (q, ds) in enumerate(downloads):
+                pieces = peer_pieces[q]
+                for d in ds:
+                    left = conf.blocks_per_piece - pieces[d.piece]
+                    # Stop while the piece still needs more than one round's
+                    # worth, so the allocation stays the same.
+                    k = min(k, (left - 1) // d.blocks)
+            return max(k, 0)
+
+        def fast_forward(k, downloads, uploads):
+            """Play out k more rounds of the same downloads and uploads."""
+            for (q, ds) in enumerate(downloads):
+                if ds:
+                    # A new row: the old one may be queued for output.
+                    pieces = copy.copy(peer_pieces[q])
+                    peer_pieces[q] = pieces
+                    for d in ds:
+                        pieces[d.piece] += k * d.blocks
+            for i in range(k):
+                history.update([list(ds) for ds in downloads],
+                               [list(us) for us in uploads])
+                if output is not None:
+                    output.round(run, round + 1 + i, self.peer_ids, downloads,
+                                 uploads, None, None)
+                if log_debug and not log_async:
+                    logging.debug(history.pretty_for_round(round + 1 + i))
+
         def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
-                            for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
+            for line in pieces_lines(self.peer_ids, peer_pieces):
+                logging.debug(line)
+            logging.info(completed_line(self.peer_ids, available))
+
+        def log_round(msg):
+            if log_async:
+                output.log(logging.INFO, msg)
+            else:
+                logging.info(msg)
+
 
+        # Only build the expensive log messages if they'll be shown.
+        log_info = logging.getLogger().isEnabledFor(logging.INFO)
+        log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
         logging.debug("Starting simulation with config: %s" % str(conf))
 
-        peers, peer_pieces = create_peers()
+        # Inside the sim, peers are known by their position in `peers`, and
+        # the per-peer tables (peer_pieces, available, up_bws, each round's
+        # requests, uploads and downloads) are lists in that order.  The
+        # string ids only appear at the edges: in messages to and from the
+        # agents, in History's public tables, and in logs.
+        peers, peer_pieces, up_bws = create_peers()
         self.peer_ids = [p.id for p in peers]
-        self.peers_by_id = dict((p.id, p) for p in peers)
+        # Position of each peer, for turning the ids agents use into indices
+        peer_index = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
         
-        upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
-
-        # dict : pid -> set(finished / available pieces)
-        available = dict((pid, set(available_pieces(pid, peer_pieces)))
-                         for pid in self.peer_ids)
+        upload_rates = dict(zip(self.peer_ids, up_bws))
+        lookbacks = dict((p.id, p.max_lookback) for p in peers)
+        for (pid, lookback) in self.min_lookbacks.items():
+            if lookbacks.get(pid) is not None and (
+                    lookback is None or lookback > lookbacks[pid]):
+                lookbacks[pid] = lookback
+        # Logs and callers that keep histories want every round.
+        keep_all = self.full_history or \
+            logging.getLogger().isEnabledFor(logging.INFO)
+        history = History(self.peer_ids, upload_rates, lookbacks, keep_all)
+
+        # With a tracker, each peer only ever sees its bounded neighbor set.
+        tracker = None
+        if conf.neighbors > 0:
+            tracker = Tracker(self.peer_ids, conf.neighbors,
+                              conf.neighbor_refresh)
+            logging.debug("Using %s" % tracker)
+
+        # Bitmask of finished / available pieces, one per peer by position
+        def initial_available(i):
+            pieces = peer_pieces[i]
+            if isinstance(pieces, SparsePieces):
+                return pieces.completed
+            return bitfield.from_pieces(available_pieces(i, peer_pieces))
+        # Seeds sharing a piece table (--aggregate-seeds) share the work.
+        masks = dict()
+        available = []
+        for i in range(len(peers)):
+            if id(peer_pieces[i]) not in masks:
+                masks[id(peer_pieces[i])] = initial_available(i)
+            available.append(masks[id(peer_pieces[i])])
+
+        # Agents run in worker processes if asked to.  They then draw from
+        # per-peer random streams, so results don't depend on the number of
+        # workers.
+        pool = None
+        agent_rngs = None
+        if conf.workers > 0:
+            if seed is None:
+                seed = random.getrandbits(32)
+            pool = AgentPool(peers, conf.workers, seed)
+        elif seed is not None:
+            agent_rngs = peer_rng_states(seed, len(peers))
+
+        telemetry = self.telemetry
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.new_run(self.peer_ids)
+        memory = self.memory
+        output = self.output
+        if output is not None:
+            run = output.new_run()
+        # The writer thread logs the round loop's own lines.
+        log_async = output is not None and output.log_rounds
+
+        # Per peer, the pieces that changed since its agent last saw them
+        changed = [[] for p in peers]
+
+        # With --aggregate-seeds: the grouped seeds' positions, a flag per
+        # position, and the one PieceSet all their PeerInfos share
+        seeds = seed_group()
+        grouped = [False] * len(peers)
+        for i in seeds:
+            grouped[i] = True
+        seed_pieces = PieceSet(all_pieces)
 
         # Begin the event loop
-        while True:
-            logging.info("======= Round %d ========" % round)
-
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
-            uploads = dict()   # peer_id -> list of Uploads
-            h = dict()
-            for p in peers:
-                h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
-
-            for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
-                
-
-            (peer_pieces, downloads) = update_peer_pieces(
-                peer_pieces, requests, uploads, available)
-            history.update(downloads, uploads)
-
-            logging.debug(history.pretty_for_round(round))
-
-            log_peer_info(peer_pieces, available)
-           
-            if all_done(peer_pieces):
-                logging.info("All done!")                    
-                break
-            round += 1
-            if round > conf.max_round:
-                logging.info("Out of time.  Stopping.")
-                break
+        try:
+            while True:
+                log_round("======= Round %d ========" % round)
+                if telemetry is not None:
+                    telemetry.start_round()
+                if trace is not None:
+                    trace.start_round(round)
+
+                if self.fork_hook is not None and round == self.fork_hook[0]:
+                    self.fork_hook[1](SimState(conf, round, peers, peer_pieces,
+                                               available, up_bws, history))
+                    # The hook may have swapped agents.
+                    seeds = seed_group()
+                    grouped = [False] * len(peers)
+                    for i in seeds:
+                        grouped[i] = True
+
+                if tracker is not None:
+                    tracker.maybe_refresh(round)
+
+                # One immutable snapshot per round, shared by every peer's view.
+                peer_info = tuple(PeerInfo(p.id, seed_pieces if grouped[i]
+                                           else PieceSet(available[i]),
+                                           available[i])
+                                  for (i, p) in enumerate(peers))
+                # Lists of Requests and of Uploads, one per peer by position
+                if pool is not None:
+                    views = [view_spec(i) for i in range(len(peers))]
+                    requests = pool.requests(
+                        peer_info, views,
+                        [piece_changes(i) for i in range(len(peers))])
+                    for (i, p) in enumerate(peers):
+                        check_requests(i, p, requests[i], peer_pieces, available)
+                    mark("requests")
+
+                    uploads = pool.uploads(requests_by_target(requests))
+                    for (i, p) in enumerate(peers):
+                        check_uploads(i, p, uploads[i])
+                    mark("uploads")
+                else:
+                    # Grouped seeds never ask for anything or look back.
+                    h = [None if grouped[i] else history.peer_history(p.id)
+                         for (i, p) in enumerate(peers)]
+                    requests = [[] if grouped[i] else
+                                get_peer_requests(i, p, peer_info, h[i], peer_pieces,
+                                                  available)
+                                for (i, p) in enumerate(peers)]
+                    mark("requests")
+
+                    requests_to = requests_by_target(requests)
+                    uploads = [None if grouped[i] else
+                               get_peer_uploads(requests_to, i, p, peer_info, h[i])
+                               for (i, p) in enumerate(peers)]
+                    if seeds:
+                        get_seed_uploads(requests_to, uploads)
+                    mark("uploads")
+
+                (peer_pieces, downloads) = update_peer_pieces(
+                    peer_pieces, requests, uploads, available)
+                for (q, ds) in enumerate(downloads):
+                    changed[q].extend(d.piece for d in ds)
+                history.update(downloads, uploads)
+                if pool is not None:
+                    pool.record(downloads, uploads)
+                mark("update")
+
+                if output is not None:
+                    output.round(run, round, self.peer_ids, downloads, uploads,
+                                 peer_pieces if log_async and log_debug else None,
+                                 available)
+                if not log_async:
+                    if log_debug:
+                        logging.debug(history.pretty_for_round(round))
+                    if log_info:
+                        log_peer_info(peer_pieces, available)
+
+                done = all_done(available)
+                mark("bookkeeping")
+                if telemetry is not None:
+                    telemetry.end_round()
+                if trace is not None:
+                    trace.end_round(dict(
+                        round=round,
+                        blocks=sum(d.blocks for ds in downloads for d in ds),
+                        finished=len([i for i in range(len(peers))
+                                      if peer_done(available, i)])))
+                if memory is not None and memory.due(round):
+                    # Agents in worker processes can't be measured from here.
+                    memory.sample(round, conf,
+                                  [("history", history),
+                                   ("peer_pieces", peer_pieces),
+                                   ("available", available)],
+                                  peers if pool is None else [])
+                if done:
+                    log_round("All done!")
+                    break
+                if conf.fast_forward and pool is None:
+                    k = steady_rounds(peer_info, downloads, h)
+                    if k > 0:
+                        log_round("Steady state: fast-forwarding %d rounds" % k)
+                        if trace is not None:
+                            start = trace.now()
+                        fast_forward(k, downloads, uploads)
+                        if trace is not None:
+                            trace.fast_forward(start, k)
+                        round += k
+                        if telemetry is not None:
+                            telemetry.end_round(k)
+                round += 1
+                if round > conf.max_round:
+                    log_round("Out of time.  Stopping.")
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+
+        if output is not None:
+            # Everything from this run is out before its summary.
+            output.flush()
+        if telemetry is not None:
+            telemetry.end_iteration()
+        if memory is not None:
+            memory.end_iteration()
+
+        if log_info:
+            logging.info("Game history:\n%s" % history.pretty())
+
+            logging.info("======== STATS ========")
+            logging.info("Uploaded blocks:\n%s" %
+                         Stats.uploaded_blocks_str(self.peer_ids, history))
+            logging.info("Completion rounds:\n%s" %
+                         Stats.completion_rounds_str(self.peer_ids, history))
+            logging.info("All done round: %s" %
+                         Stats.all_done_round(self.peer_ids, history))
 
-        logging.info("Game history:\n%s" % history.pretty())
+        return history
 
-        logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
+    def iteration_seed(self, i):
+        """The common-random-numbers seed for iteration i, or None."""
+        if self.config.crn_seed is None:
+            return None
+        return self.config.crn_seed + i
 
-        return history
+    def start_telemetry(self):
+        """Start reporting progress if the config asks for it."""
+        c = self.config
+        if c.metrics_file is None and c.metrics_port is None:
+            return
+        self.telemetry = Telemetry(c.iters, c.max_round, c.metrics_file,
+                                   c.metrics_port, c.metrics_interval)
+
+    def stop_telemetry(self):
+        if self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
+
+    def start_tracing(self):
+        """Start recording a timeline if the config asks for it."""
+        c = self.config
+        if c.trace_file is not None:
+            self.tracer = Tracer(c.trace_file, c.trace_every, c.trace_buffer)
+
+    def stop_tracing(self):
+        if self.tracer is not None:
+            tracer = self.tracer
+            self.tracer = None
+            tracer.close()
+            if tracer.dropped() > 0:
+                logging.warning("Trace buffer full: kept the last %d of %d spans" %
+                                (tracer.spans - tracer.dropped(), tracer.spans))
+
+    def start_output(self):
+        """Start the background writer if the config asks for it."""
+        c = self.config
+        if c.history_file is None and not c.async_output:
+            return
+        self.output = OutputWriter(c.history_file, c.async_output,
+                                   c.output_queue)
+
+    def stop_output(self):
+        if self.output is not None:
+            output = self.output
+            self.output = None
+            output.close()
+            if output.waits > 0:
+                logging.info("Output queue was full %d times" % output.waits)
+
+    def open_results(self, db=None):
+        """Use db (a ResultsDB), or the process's connection to the config's
+        --results-db, if any, for the iterations to come."""
+        if db is None and self.config.results_db is not None:
+            db = resultsdb.shared(self.config.results_db)
+        self.results_db = db
+
+    def run_iterations(self):
+        """Run config.iters iterations and return their histories, adding
+        each one to the results database as soon as it's done."""
+        histories = []
+        for i in range(self.config.iters):
+            seed = self.iteration_seed(i)
+            history = self.run_sim_once(seed)
+            histories.append(history)
+            if self.results_db is not None:
+                self.results_db.add(self.config,
+                                    SimResult(self.peer_ids, [history]),
+                                    [seed], i)
+        return histories
 
     def run_sim(self):
-        histories = map(lambda i: self.run_sim_once(), 
-                        range(self.config.iters))
+        c = self.config
+        if c.mem_every > 0:
+            self.memory = MemoryProfiler(c.mem_every)
+        self.start_telemetry()
+        self.start_tracing()
+        self.start_output()
+        self.open_results()
+        try:
+            histories = self.run_iterations()
+        finally:
+            self.stop_output()
+            self.stop_tracing()
+            self.stop_telemetry()
+        if self.memory is not None:
+            log_report(self.memory)
+            self.memory = None
         logging.warning("======== SUMMARY STATS ========")
         
         uploaded_blocks = map(
@@ -395,17 +853,47 @@ class Sim:
 
 
 
-def configure_logging(loglevel):
+def peer_ids_for(class_names):
+    """The peer ids a lineup gets: each class name with a counter, so
+    ['Seed', 'Dummy', 'Seed'] -> ['Seed0', 'Dummy0', 'Seed1']."""
+    counts = dict()
+    def index(name):
+        if name in counts:
+            a = counts[name]
+            counts[name] += 1
+        else:
+            a = 0
+            counts[name] = 1
+        return a
+
+    return map(lambda n: "%s%d" % (n,index(n)), class_names)
+
+
+# The handler installed by configure_logging, if any
+_log_handler = None
+
+def configure_logging(loglevel, stream=None):
+    """
+    Log to stream (default: the real stdout) at the given level.  Calling
+    it again replaces the handler it installed last time instead of adding
+    another one.
+    """
+    global _log_handler
     numeric_level = getattr(logging, loglevel.upper(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % loglevel)
 
+    if stream is None:
+        stream = sys.__stdout__
     root_logger = logging.getLogger('')
-    strm_out = logging.StreamHandler(sys.__stdout__)
+    if _log_handler is not None:
+        root_logger.removeHandler(_log_handler)
+    strm_out = logging.StreamHandler(stream)
 #    strm_out.setFormatter(logging.Formatter('%(levelno)s: %(message)s'))
     strm_out.setFormatter(logging.Formatter('%(message)s'))
     root_logger.setLevel(numeric_level)
     root_logger.addHandler(strm_out)
+    _log_handler = strm_out
     
 
 def parse_agents(args):
@@ -429,15 +917,12 @@ def parse_agents(args):
             
         
 
-def main(args):
+def make_option_parser():
+    """The command line options, which also serve as the defaults for
+    configs coming from elsewhere (see server.py)."""
     usage_msg = "Usage:  %prog [options] PeerClass1[,count] PeerClass2[,count] ..."
     parser = OptionParser(usage=usage_msg)
 
-    def usage(msg):
-        print "Error: %s\n" % msg
-        parser.print_help()
-        sys.exit()
-    
     parser.add_option("--loglevel",
                       dest="loglevel", default="info",
                       help="Set the logging level: 'debug' or 'info'")
@@ -466,6 +951,244 @@ def main(args):
                       dest="iters", default=1, type="int",
                       help="Number of times to run simulation to get stats")
 
+    parser.add_option("--neighbors",
+                      dest="neighbors", default=0, type="int",
+                      help="Peers handed out by the tracker to each peer (0 = everyone)")
+
+    parser.add_option("--neighbor-refresh",
+                      dest="neighbor_refresh", default=0, type="int",
+                      help="Rebuild tracker neighbor sets every N rounds (0 = never)")
+
+    parser.add_option("--sparse-pieces",
+                      dest="sparse_pieces", default=False, action="store_true",
+                      help="Store piece state sparsely, for files with many pieces")
+
+    parser.add_option("--crn-seed",
+                      dest="crn_seed", default=None, type="int",
+                      help="Use common random numbers: iteration i is seeded with CRN_SEED+i")
+
+    parser.add_option("--paired",
+                      dest="paired", default=None,
+                      help="Also run this agent list (e.g. 'ArmlB1Std,2 Seed') on the same random numbers and report paired differences")
+
+    parser.add_option("--workers",
+                      dest="workers", default=0, type="int",
+                      help="Run agents in N worker processes (0 = in-process)")
+
+    parser.add_option("--metrics-file",
+                      dest="metrics_file", default=None,
+                      help="Periodically write progress metrics (Prometheus text format) to this file")
+
+    parser.add_option("--metrics-port",
+                      dest="metrics_port", default=None, type="int",
+                      help="Serve progress metrics on http://127.0.0.1:PORT/metrics")
+
+    parser.add_option("--metrics-interval",
+                      dest="metrics_interval", default=5.0, type="float",
+                      help="Seconds between progress metrics updates")
+
+    parser.add_option("--mem-every",
+                      dest="mem_every", default=0, type="int",
+                      help="Measure retained memory by sim structure and agent class every N rounds, and report its growth (0 = off)")
+
+    parser.add_option("--results-db",
+                      dest="results_db", default=None,
+                      help="Add each iteration's per-peer results to this SQLite database (see resultsdb.py)")
+
+    parser.add_option("--trace-file",
+                      dest="trace_file", default=None,
+                      help="Write a timeline of rounds, phases and agent calls to this file (Chrome trace JSON)")
+
+    parser.add_option("--trace-every",
+                      dest="trace_every", default=1, type="int",
+                      help="With --trace-file, trace agent calls every N rounds")
+
+    parser.add_option("--trace-buffer",
+                      dest="trace_buffer", default=1000000, type="int",
+                      help="With --trace-file, keep at most this many spans (the most recent)")
+
+    parser.add_option("--history-file",
+                      dest="history_file", default=None,
+                      help="Write every round's downloads and uploads to this file, one JSON object per line, from a background thread")
+
+    parser.add_option("--async-output",
+                      dest="async_output", default=False, action="store_true",
+                      help="Format and log the per-round output from a background thread")
+
+    parser.add_option("--output-queue",
+                      dest="output_queue", default=1024, type="int",
+                      help="Rounds the background writer may fall behind before the sim waits for it")
+
+    parser.add_option("--aggregate-seeds",
+                      dest="aggregate_seeds", default=False, action="store_true",
+                      help="Handle all Seed peers as one group: a shared piece table and one batched uploads call (in-process agents only)")
+
+    parser.add_option("--fast-forward",
+                      dest="fast_forward", default=False, action="store_true",
+                      help="Skip ahead through rounds where every agent declares a steady state (in-process agents only).  Of the bundled agents only Seed does, and only while at most one peer asks it; the others draw random numbers every round, so a run with any of them never skips")
+
+    return parser
+
+
+def make_config(options, agents_to_run, agent_classes=None):
+    """
+    Build the sim Params from parsed options and a list of agent class
+    names.  agent_classes: class_name -> class, if already loaded.
+    """
+    config = Params()
+
+    config.add("agent_class_names", agents_to_run)
+    if agent_classes is None:
+        agent_classes = load_modules(config.agent_class_names)
+    config.add("agent_classes", agent_classes)
+
+    config.add("num_pieces", options.num_pieces)
+    config.add("blocks_per_piece",options.blocks_per_piece)
+    config.add("max_round", options.max_round)
+    config.add("min_up_bw", options.min_up_bw)
+    config.add("max_up_bw", options.max_up_bw)
+    config.add("iters", options.iters)
+    config.add("neighbors", options.neighbors)
+    config.add("neighbor_refresh", options.neighbor_refresh)
+    config.add("workers", options.workers)
+    config.add("sparse_pieces", options.sparse_pieces)
+    config.add("crn_seed", options.crn_seed)
+    config.add("metrics_file", options.metrics_file)
+    config.add("metrics_port", options.metrics_port)
+    config.add("metrics_interval", options.metrics_interval)
+    config.add("fast_forward", options.fast_forward)
+    config.add("mem_every", options.mem_every)
+    config.add("aggregate_seeds", options.aggregate_seeds)
+    config.add("results_db", options.results_db)
+    config.add("trace_file", options.trace_file)
+    config.add("trace_every", options.trace_every)
+    config.add("trace_buffer", options.trace_buffer)
+    config.add("history_file", options.history_file)
+    config.add("async_output", options.async_output)
+    config.add("output_queue", options.output_queue)
+    return config
+
+
+# make_option_parser().get_default_values(), built on first use
+_option_defaults = None
+
+def config_from_dict(d):
+    """
+    Build the sim Params from a dict.  "agents" is a list of
+    "Class[,count]" strings as on the command line (default: two Dummies
+    and a Seed); every other key is an option's dest name (num_pieces,
+    max_round, ...), and anything left out gets the command line default.
+    Raises ValueError on unknown keys.
+    """
+    global _option_defaults
+    if _option_defaults is None:
+        _option_defaults = make_option_parser().get_default_values()
+    options = copy.copy(_option_defaults)
+    for (k, v) in d.items():
+        if k == "agents":
+            continue
+        if k in ("loglevel", "paired") or not hasattr(options, k):
+            raise ValueError("Unknown sim option: %s" % k)
+        setattr(options, k, v)
+    agents = parse_agents(d.get("agents", ["Dummy", "Dummy", "Seed"]))
+    return make_config(options, agents)
+
+
+class SimResult:
+    """
+    What simulate() returns.  Each list has one entry per iteration:
+
+    upload_rates: [dict : peer_id -> up_bw]
+    uploaded_blocks: [dict : peer_id -> blocks uploaded]
+    completion_rounds: [dict : peer_id -> round finished, or None]
+    all_done_rounds: [round everyone was done, or None]
+    histories: [History], only if simulate() was asked to keep them
+    """
+    def __init__(self, peer_ids, histories, keep_histories=False):
+        self.peer_ids = peer_ids
+        self.upload_rates = [h.upload_rates for h in histories]
+        self.uploaded_blocks = [Stats.uploaded_blocks(peer_ids, h)
+                                for h in histories]
+        self.completion_rounds = [Stats.completion_rounds(peer_ids, h)
+                                  for h in histories]
+        self.all_done_rounds = [Stats.all_done_round(peer_ids, h)
+                                for h in histories]
+        self.histories = None
+        if keep_histories:
+            self.histories = histories
+
+    def extend(self, other):
+        """Add the iterations of another SimResult for the same peers."""
+        self.upload_rates.extend(other.upload_rates)
+        self.uploaded_blocks.extend(other.uploaded_blocks)
+        self.completion_rounds.extend(other.completion_rounds)
+        self.all_done_rounds.extend(other.all_done_rounds)
+        if self.histories is not None and other.histories is not None:
+            self.histories.extend(other.histories)
+
+    def as_dict(self):
+        """Compact form: per iteration, one list in the order of peer_ids."""
+        def per_peer(ds):
+            return [[d[pid] for pid in self.peer_ids] for d in ds]
+        return dict(peers=self.peer_ids,
+                    bw=per_peer(self.upload_rates),
+                    uploaded=per_peer(self.uploaded_blocks),
+                    rounds=per_peer(self.completion_rounds))
+
+    def __repr__(self):
+        return "SimResult(peers=%d, iters=%d, all_done_rounds=%s)" % (
+            len(self.peer_ids), len(self.all_done_rounds),
+            self.all_done_rounds)
+
+
+def simulate(config, seed=None, keep_histories=False, results_db=None):
+    """
+    Run config["iters"] simulations of a config dict (see
+    config_from_dict) and return a SimResult.
+
+    The sim and the agents draw from their own random stream, seeded with
+    seed (or from the OS if None), swapped in for the global one for the
+    duration of the call: the caller's random state is left untouched, and
+    the same seed gives the same result.  Agent modules are only imported
+    once per process, and logging is left however the caller set it up.
+
+    Each iteration is added to results_db (a ResultsDB) if given, or else
+    to the config's results_db path through the process's one connection
+    to it (resultsdb.shared).
+    """
+    params = config_from_dict(config)
+    sim = None
+    saved = random.getstate()
+    random.setstate(random.Random(seed).getstate())
+    try:
+        sim = Sim(params)
+        sim.full_history = keep_histories
+        if params.mem_every > 0:
+            sim.memory = MemoryProfiler(params.mem_every)
+        sim.start_telemetry()
+        sim.start_tracing()
+        sim.start_output()
+        sim.open_results(results_db)
+        histories = sim.run_iterations()
+    finally:
+        random.setstate(saved)
+        if sim is not None:
+            sim.stop_output()
+            sim.stop_tracing()
+            sim.stop_telemetry()
+    if sim.memory is not None:
+        log_report(sim.memory)
+        sim.memory = None
+    return SimResult(sim.peer_ids, histories, keep_histories)
+
+
+def main(args):
+    parser = make_option_parser()
+
+    def usage(msg):
+        print "Error: %s\n" % msg
+        parser.print_help()
+        sys.exit()
 
     (options, args) = parser.parse_args()
 
@@ -482,19 +1205,24 @@ def main(args):
             usage(e)
     
     configure_logging(options.loglevel)
-    config = Params()
+    config = make_config(options, agents_to_run)
 
-    config.add("agent_class_names", agents_to_run)
-    config.add("agent_classes", load_modules(config.agent_class_names))
+    if options.paired is not None:
+        try:
+            variant = parse_agents(options.paired.split())
+        except ValueError, e:
+            usage(e)
+        if len(variant) != len(agents_to_run):
+            usage("--paired needs the same number of peers as the main lineup")
+        if config.crn_seed is None:
+            config.crn_seed = random.getrandbits(32)
+            logging.warning("Using --crn-seed %d" % config.crn_seed)
+        variant_config = make_config(options, variant)
+        result = run_paired(Sim(config), Sim(variant_config), config.iters,
+                            config.crn_seed)
+        log_paired(result)
+        return
 
-    
-    config.add("num_pieces", options.num_pieces)
-    config.add("blocks_per_piece",options.blocks_per_piece)
-    config.add("max_round", options.max_round)
-    config.add("min_up_bw", options.min_up_bw)
-    config.add("max_up_bw", options.max_up_bw)
-    config.add("iters", options.iters)
-    
     sim = Sim(config)
     sim.run_sim()
 
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+"""
+Progress and throughput telemetry for long runs.
+
+Every `interval` seconds (checked at the end of a round, so it costs a
+couple of time.time() calls per round otherwise) this writes a snapshot
+in the Prometheus text format to a metrics file, and, if asked, serves the
+same text over HTTP on localhost.
+"""
+
+import os
+import time
+import resource
+import threading
+import BaseHTTPServer
+
+PHASES = ["requests", "uploads", "update", "bookkeeping"]
+
+
+def rss_bytes():
+    """Current resident set size, or the peak if /proc isn't there."""
+    try:
+        f = open("/proc/self/statm")
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Telemetry:
+    def __init__(self, total_iters, max_round, path=None, port=None,
+                 interval=5.0):
+        """
+        total_iters: iterations this run will do, for the ETA
+        max_round: upper bound on rounds per iteration, used for the ETA
+            until the first iteration finishes
+        path: metrics file to (re)write, or None
+        port: serve the metrics on http://127.0.0.1:port/metrics, or None
+        """
+        self.total_iters = total_iters
+        self.max_round = max_round
+        self.path = path
+        self.interval = interval
+
+        self.start = time.time()
+        self.last_report = self.start
+        self.last_mark = self.start
+        self.rounds = 0
+        self.rounds_this_iter = 0
+        self.iters_done = 0
+        self.phase_seconds = dict((p, 0.0) for p in PHASES)
+        self.text = ""
+        self.report_rounds = 0
+        self.rate = 0.0
+
+        self.server = None
+        if port is not None:
+            self.serve(port)
+
+    def serve(self, port):
+        telemetry = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = telemetry.text
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def start_round(self):
+        self.last_mark = time.time()
+
+    def mark(self, phase):
+        """Charge the time since the last mark to phase."""
+        now = time.time()
+        self.phase_seconds[phase] += now - self.last_mark
+        self.last_mark = now
+
+    def end_round(self, rounds=1):
+        self.rounds += rounds
+        self.rounds_this_iter += rounds
+        if self.last_mark - self.last_report >= self.interval:
+            self.report()
+
+    def end_iteration(self):
+        self.iters_done += 1
+        self.rounds_this_iter = 0
+        self.report()
+
+    def eta_seconds(self, now):
+        if self.iters_done >= self.total_iters:
+            return 0.0
+        if self.iters_done > 0:
+            rounds_per_iter = float(self.rounds - self.rounds_this_iter) / self.iters_done
+        else:
+            rounds_per_iter = self.max_round + 1
+        done = self.iters_done + min(1.0, self.rounds_this_iter / rounds_per_iter)
+        if done == 0:
+            return None
+        elapsed = now - self.start
+        return elapsed * (self.total_iters - done) / done
+
+    def snapshot(self):
+        now = time.time()
+        since = now - self.last_report
+        if self.rounds > self.report_rounds and since > 0:
+            # Otherwise keep the last rate, e.g. for the report that closes
+            # an iteration right after a periodic one.
+            self.rate = (self.rounds - self.report_rounds) / since
+        lines = [
+            "# TYPE p2psim_rounds_total counter",
+            "p2psim_rounds_total %d" % self.rounds,
+            "# TYPE p2psim_rounds_per_second gauge",
+            "p2psim_rounds_per_second %.3f" % self.rate,
+            "# TYPE p2psim_iterations_completed gauge",
+            "p2psim_iterations_completed %d" % self.iters_done,
+            "# TYPE p2psim_iterations_total gauge",
+            "p2psim_iterations_total %d" % self.total_iters,
+            "# TYPE p2psim_elapsed_seconds gauge",
+            "p2psim_elapsed_seconds %.3f" % (now - self.start),
+        ]
+        eta = self.eta_seconds(now)
+        if eta is not None:
+            lines.extend(["# TYPE p2psim_eta_seconds gauge",
+                          "p2psim_eta_seconds %.3f" % eta])
+        lines.extend(["# TYPE p2psim_rss_bytes gauge",
+                      "p2psim_rss_bytes %d" % rss_bytes(),
+                      "# TYPE p2psim_phase_seconds_total counter"])
+        for p in PHASES:
+            lines.append('p2psim_phase_seconds_total{phase="%s"} %.6f' % (
+                p, self.phase_seconds[p]))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        self.text = self.snapshot()
+        self.last_report = time.time()
+        self.report_rounds = self.rounds
+        if self.path is not None:
+            tmp = "%s.tmp" % self.path
+            f = open(tmp, "w")
+            try:
+                f.write(self.text)
+            finally:
+                f.close()
+            os.rename(tmp, self.path)
+
+    def close(self):
+        self.report()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+--fast-forward must leave the same History as playing every round.  Run
+with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bitfield
+from messages import Request
+from peer import Peer
+from seed import Seed
+from sim import Sim, make_config, make_option_parser
+
+
+class Mono(Peer):
+    """Asks one Seed (MonoN asks Seed N mod 3) for the lowest piece it
+    still needs, and never draws random numbers, so it's always steady."""
+    calls = 0
+
+    def steady_state(self, history):
+        return True
+
+    def requests(self, peers, history):
+        Mono.calls += 1
+        seed_id = "Seed%d" % (int(self.id[len("Mono"):]) % 3)
+        for p in peers:
+            if p.id == seed_id:
+                need = bitfield.to_list(p.available_mask & self.needed_mask())
+                if need:
+                    return [Request(self.id, p.id, need[0],
+                                    self.pieces[need[0]])]
+        return []
+
+
+def run(agents, fast_forward, crn_seed):
+    """Histories of two iterations, and how many times Mono was asked."""
+    options = make_option_parser().get_default_values()
+    options.num_pieces = 4
+    options.blocks_per_piece = 32
+    options.min_up_bw = 3
+    options.max_up_bw = 6
+    options.max_round = 500
+    options.iters = 2
+    options.crn_seed = crn_seed
+    options.fast_forward = fast_forward
+    config = make_config(options, agents, dict(Mono=Mono, Seed=Seed))
+    Mono.calls = 0
+    saved = random.getstate()
+    random.seed(7)
+    try:
+        sim = Sim(config)
+        sim.full_history = True
+        histories = [sim.run_sim_once(sim.iteration_seed(i))
+                     for i in range(config.iters)]
+    finally:
+        random.setstate(saved)
+    return (histories, Mono.calls)
+
+
+def contents(history):
+    """Everything a History records, in comparable form."""
+    ids = history.peer_ids
+    return dict(
+        downloads=[[[(d.from_id, d.piece, d.blocks) for d in ds]
+                    for ds in history.downloads[pid]] for pid in ids],
+        uploads=[[[(u.to_id, u.bw) for u in us]
+                  for us in history.uploads[pid]] for pid in ids],
+        uploaded=[history.uploaded[pid] for pid in ids],
+        downloaded=[history.downloaded[pid] for pid in ids],
+        round_done=history.round_done,
+        last_round=history.last_round())
+
+
+class FastForwardTest(unittest.TestCase):
+    def check_same(self, agents, crn_seed):
+        (full, full_calls) = run(agents, False, crn_seed)
+        (ff, ff_calls) = run(agents, True, crn_seed)
+        for (a, b) in zip(full, ff):
+            self.assertEqual(contents(a), contents(b))
+        return (full_calls, ff_calls)
+
+    def test_skips_rounds_with_one_requester_per_seed(self):
+        for crn_seed in (None, 11):
+            (full_calls, ff_calls) = self.check_same(
+                ["Mono", "Mono", "Mono", "Seed", "Seed", "Seed"], crn_seed)
+            self.assertTrue(ff_calls < full_calls / 2)
+
+    def test_shared_seed_orders_uploads_at_random(self):
+        # Mono0 and Mono3 both ask Seed0, whose upload order is random
+        for crn_seed in (None, 11):
+            self.check_same(["Mono"] * 4 + ["Seed"] * 3, crn_seed)
+
+
+if __name__ == "__main__":
+    unittest.main()
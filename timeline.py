@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+"""
+Opt-in timeline tracing (--trace-file PATH).
+
+Records a span for every round, for each phase of it (requests, uploads,
+update, bookkeeping) and for fast-forwards, plus one per agent
+requests() / uploads() call, and writes them as Chrome trace event JSON:
+open the file in chrome://tracing or https://ui.perfetto.dev.  The round
+loop is the first thread in the viewer and every peer id gets a thread of
+its own for its agent calls; iterations follow each other along the time
+axis.  Round spans carry the iteration, the round number, the blocks
+downloaded and how many peers have finished, so a slow round can be
+lined up with what happened in it.
+
+To keep the overhead bounded on huge runs:
+  - agent calls are only traced every --trace-every rounds (rounds and
+    phases always are, they're a handful of spans per round)
+  - spans go into a ring buffer of --trace-buffer events, so a long run
+    keeps its most recent spans and the file says how many were dropped.
+    Thread names are only recorded once per peer id, however many
+    iterations there are.
+Agents in worker processes (--workers) aren't traced one by one.
+"""
+
+import json
+import time
+from collections import deque
+
+
+class RunTrace:
+    """The spans of one iteration, fed by the round loop."""
+    def __init__(self, tracer, iteration, tids):
+        """tids: the thread of each peer, by position"""
+        self.tracer = tracer
+        self.iteration = iteration
+        self.tids = tids
+        self.round = None
+        self.round_start = None
+        self.last_mark = None
+        # Trace agent calls this round?
+        self.sampled = False
+
+    def now(self):
+        return self.tracer.now()
+
+    def start_round(self, round):
+        self.round = round
+        self.round_start = self.last_mark = self.now()
+        self.sampled = self.tracer.sampled(round)
+
+    def mark(self, phase):
+        """A span for phase, from the last mark till now."""
+        now = self.now()
+        self.tracer.span(0, phase, "phase", self.last_mark, now)
+        self.last_mark = now
+
+    def agent(self, i, name, start):
+        """A span for peer i's call to name, from start till now."""
+        self.tracer.span(self.tids[i], name, "agent", start, self.now(),
+                         {"iteration": self.iteration, "round": self.round})
+
+    def end_round(self, args):
+        args["iteration"] = self.iteration
+        self.tracer.span(0, "round %d" % self.round, "round",
+                         self.round_start, self.now(), args)
+
+    def fast_forward(self, start, k):
+        self.tracer.span(0, "fast-forward", "round", start, self.now(),
+                         {"iteration": self.iteration, "round": self.round,
+                          "rounds": k})
+
+
+class Tracer:
+    def __init__(self, path, every=1, capacity=1000000):
+        """
+        path: write the trace here on close()
+        every: trace agent calls in every this many rounds
+        capacity: spans kept; older ones are dropped first
+        """
+        self.path = path
+        self.every = max(every, 1)
+        self.events = deque(maxlen=capacity)
+        self.spans = 0
+        # peer id -> thread; their names are the only events never dropped
+        self.tids = dict()
+        self.runs = 0
+        self.origin = time.time()
+
+    def now(self):
+        """Microseconds since the tracer started"""
+        return (time.time() - self.origin) * 1e6
+
+    def sampled(self, round):
+        return round % self.every == 0
+
+    def new_run(self, peer_ids):
+        """A RunTrace for the next iteration."""
+        for pid in peer_ids:
+            if pid not in self.tids:
+                self.tids[pid] = len(self.tids) + 1
+        self.runs += 1
+        return RunTrace(self, self.runs - 1, [self.tids[pid] for pid in peer_ids])
+
+    def metadata(self):
+        names = [(0, "sim")] + [(tid, pid) for (pid, tid) in self.tids.items()]
+        events = [dict(ph="M", pid=0, tid=0, name="process_name",
+                       args={"name": "sim"})]
+        for (tid, name) in sorted(names):
+            events.append(dict(ph="M", pid=0, tid=tid, name="thread_name",
+                               args={"name": name}))
+            events.append(dict(ph="M", pid=0, tid=tid, name="thread_sort_index",
+                               args={"sort_index": tid}))
+        return events
+
+    def span(self, tid, name, cat, start, end, args=None):
+        self.spans += 1
+        self.events.append((tid, name, cat, start, end, args))
+
+    def dropped(self):
+        return self.spans - len(self.events)
+
+    def close(self):
+        events = self.metadata()
+        for (tid, name, cat, start, end, args) in self.events:
+            e = dict(ph="X", pid=0, tid=tid, name=name, cat=cat,
+                     ts=round(start, 1), dur=round(end - start, 1))
+            if args is not None:
+                e["args"] = args
+            events.append(e)
+        f = open(self.path, "w")
+        try:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms",
+                           otherData=dict(spans=self.spans,
+                                          dropped=self.dropped(),
+                                          every=self.every,
+                                          iterations=self.runs)),
+                      f, separators=(",", ":"))
+        finally:
+            f.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+import random
+
+
+class Tracker:
+    """
+    Hands each peer a bounded set of neighbors, the way a real BitTorrent
+    tracker returns a limited peer list instead of the whole swarm.
+
+    neighbors: dict : peer_id -> set(neighbor peer ids)
+
+    The adjacency is symmetric: if a is a neighbor of b, b is a neighbor of
+    a.  Each peer asks for `degree` random peers, so a peer may end up with
+    a few more than `degree` neighbors from other peers' announces.
+    """
+    def __init__(self, peer_ids, degree, refresh=0):
+        """
+        peer_ids: list of all peer ids in the swarm
+        degree: number of peers handed out per announce
+        refresh: rebuild the neighbor sets every `refresh` rounds (0 = never)
+        """
+        self.peer_ids = peer_ids[:]
+        self.degree = degree
+        self.refresh = refresh
+        self.neighbors = dict()
+        self._sorted = dict()
+        self.rebuild()
+
+    def rebuild(self):
+        """Hand every peer a fresh random set of neighbors."""
+        ids = self.peer_ids
+        n = len(ids)
+        k = min(self.degree, n - 1)
+        self.neighbors = dict((pid, set()) for pid in ids)
+        self._sorted = dict()
+        for i, pid in enumerate(ids):
+            mine = self.neighbors[pid]
+            # Sample one extra index so that skipping ourselves still
+            # leaves k candidates.
+            for j in random.sample(xrange(n), min(k + 1, n)):
+                if len(mine) >= k:
+                    break
+                if j == i:
+                    continue
+                other = ids[j]
+                mine.add(other)
+                self.neighbors[other].add(pid)
+
+    def maybe_refresh(self, round):
+        """Re-announce at the configured interval.  Returns True if the
+        neighbor sets changed."""
+        if self.refresh > 0 and round > 0 and round % self.refresh == 0:
+            self.rebuild()
+            return True
+        return False
+
+    def neighbors_of(self, peer_id):
+        """Sorted list of neighbor ids, so iteration order is reproducible."""
+        if peer_id not in self._sorted:
+            self._sorted[peer_id] = sorted(self.neighbors[peer_id])
+        return self._sorted[peer_id]
+
+    def are_neighbors(self, a, b):
+        return b in self.neighbors[a]
+
+    def __repr__(self):
+        return "Tracker(peers=%d, degree=%d, refresh=%d)" % (
+            len(self.peer_ids), self.degree, self.refresh)
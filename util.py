@@ -86,14 +86,21 @@ def even_split(n, k):
     return ans
 
 
+# class_name -> class, for every agent class loaded so far
+_loaded_classes = dict()
+
 def load_modules(agent_classes):
     """Each agent class must be in module class_name.lower().
-    Returns a dictionary class_name->class"""
+    Returns a dictionary class_name->class.  Classes are looked up only
+    once per process."""
 
     def load(class_name):
+        if class_name in _loaded_classes:
+            return (class_name, _loaded_classes[class_name])
         module_name = class_name.lower()  # by convention / fiat
         module = __import__(module_name)
         agent_class = module.__dict__[class_name]
+        _loaded_classes[class_name] = agent_class
         return (class_name, agent_class)
 
     return dict(map(load, agent_classes))
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+"""
+Spread a sweep over many machines through a shared work directory.
+
+The coordinator reads sim configs as JSON lines (the same format as
+server.py requests) and splits each one into work units of a single
+iteration.  Iteration i of a config runs with common random numbers seeded
+with crn_seed + i, as sim.py's iteration i does (see Sim.run_sim_once), so
+a unit gives the same answer wherever and however often it is run; a
+config without a crn_seed gets a random one.  "seed" means what it does in
+server.py: it seeds the random number generator, here for each unit of the
+config.  Workers on any host that can see the directory claim units, run
+them, and write back compact results; the coordinator stitches them back
+together and prints one JSON line per config, as server.py would.
+
+Each coordinator run is a sweep with a fresh random SWEEP id and its own
+subdirectory, so any number of sweeps can share one directory without
+touching each other's files.  Layout (UNIT is CONFIG-ITERATION):
+    SWEEP/pending/UNIT.json         waiting to be claimed
+    SWEEP/claimed/UNIT.json.WORKER  being run; the worker touches it as a
+                                    heartbeat
+    SWEEP/results/UNIT.json         finished
+    SWEEP/done                      exists once the coordinator has
+                                    everything
+
+Claiming is an atomic rename from pending/ to claimed/, so two workers
+never run the same unit.  A claim whose heartbeat is older than the lease
+goes back to pending/ (the worker is assumed lost), up to --max-attempts
+times.  A worker serves every sweep in the directory that isn't done, or
+only one with --sweep (as the coordinator's --local-workers do, which exit
+when it is done).  Finished sweeps are left in place for whoever wants to
+clear them out.
+
+    workqueue.py coordinator --dir D [--local-workers N] < sweep.jsonl
+    workqueue.py worker --dir D [--sweep SWEEP] [--idle-exit S]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import threading
+import traceback
+import subprocess
+from optparse import OptionParser
+
+from sim import configure_logging, simulate
+
+PENDING = "pending"
+CLAIMED = "claimed"
+RESULTS = "results"
+DONE = "done"
+
+
+def write_json(path, obj):
+    """Write atomically: readers only ever see a complete file."""
+    tmp = "%s.tmp.%d" % (path, os.getpid())
+    f = open(tmp, "w")
+    try:
+        json.dump(obj, f, separators=(",", ":"))
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+
+def read_json(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def make_dirs(sweep_dir):
+    for d in (PENDING, CLAIMED, RESULTS):
+        path = os.path.join(sweep_dir, d)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+
+def new_sweep_id():
+    return os.urandom(4).encode("hex")
+
+
+def unit_name(config_index, iteration):
+    return "%06d-%06d.json" % (config_index, iteration)
+
+
+def open_sweeps(queue_dir):
+    """The directories of the sweeps in queue_dir that aren't done yet."""
+    ans = []
+    for name in os.listdir(queue_dir):
+        path = os.path.join(queue_dir, name)
+        if os.path.isdir(os.path.join(path, PENDING)) and \
+                not os.path.exists(os.path.join(path, DONE)):
+            ans.append(path)
+    return ans
+
+
+def split_sweep(requests):
+    """
+    Turn a list of decoded requests into work units (name, config,
+    seed), one per iteration.  Each unit runs a single iteration with
+    crn_seed = the request's crn_seed + iteration.
+    """
+    units = []
+    for (c, request) in enumerate(requests):
+        config = dict(request)
+        config.pop("id", None)
+        seed = config.pop("seed", None)
+        crn_seed = config.pop("crn_seed", None)
+        if crn_seed is None:
+            crn_seed = random.getrandbits(32)
+        iters = config.pop("iters", 1)
+        if config.get("workers", 0) > 0:
+            raise ValueError("workers isn't supported in queue mode")
+        for i in range(iters):
+            unit_config = dict(config, iters=1, crn_seed=crn_seed + i)
+            units.append((unit_name(c, i), unit_config, seed))
+    return units
+
+
+class Coordinator:
+    def __init__(self, queue_dir, sweep, lease, max_attempts, poll=0.2):
+        self.sweep_dir = os.path.join(queue_dir, sweep)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll = poll
+
+    def path(self, *parts):
+        return os.path.join(self.sweep_dir, *parts)
+
+    def submit(self, units):
+        make_dirs(self.sweep_dir)
+        for (name, config, seed) in units:
+            write_json(self.path(PENDING, name),
+                       dict(unit=name, config=config, seed=seed, attempts=0))
+
+    def requeue_stale(self, failed):
+        """Put claims with a stale heartbeat back in pending/."""
+        now = time.time()
+        for claim in os.listdir(self.path(CLAIMED)):
+            path = self.path(CLAIMED, claim)
+            name = claim[:claim.index(".json") + len(".json")]
+            try:
+                if now - os.stat(path).st_mtime < self.lease:
+                    continue
+                unit = read_json(path)
+                os.remove(path)
+            except (OSError, IOError, ValueError):
+                # Finished or requeued under our feet
+                continue
+            if os.path.exists(self.path(RESULTS, name)):
+                continue
+            unit["attempts"] += 1
+            if unit["attempts"] >= self.max_attempts:
+                logging.warning("Giving up on %s after %d attempts" % (
+                    name, unit["attempts"]))
+                failed[name] = dict(unit=name, error="lost %d times" %
+                                    unit["attempts"])
+                continue
+            logging.warning("Requeueing %s from lost worker %s" % (
+                name, claim[len(name) + 1:]))
+            write_json(self.path(PENDING, name), unit)
+
+    def wait(self, names):
+        """Block until every unit has a result; return name -> result."""
+        names = set(names)
+        results = dict()
+        failed = dict()
+        while True:
+            for name in os.listdir(self.path(RESULTS)):
+                if name in names and name not in results:
+                    results[name] = read_json(self.path(RESULTS, name))
+            results.update(failed)
+            if len(results) == len(names):
+                break
+            self.requeue_stale(failed)
+            time.sleep(self.poll)
+        open(self.path(DONE), "w").close()
+        return results
+
+
+def merge_results(requests, results):
+    """One response per request, with the iterations in order."""
+    for (c, request) in enumerate(requests):
+        response = dict(id=request.get("id"))
+        for i in range(request.get("iters", 1)):
+            r = results[unit_name(c, i)]
+            if "error" in r:
+                response = dict(id=request.get("id"), error=r["error"])
+                break
+            r = r["result"]
+            response["peers"] = r["peers"]
+            for k in ("bw", "uploaded", "rounds"):
+                response.setdefault(k, []).extend(r[k])
+        yield response
+
+
+def heartbeat(path, interval, stop):
+    while not stop.wait(interval):
+        try:
+            os.utime(path, None)
+        except OSError:
+            return
+
+
+def claim_unit(sweep_dir, worker_id):
+    """Claim a pending unit; return (claim path, unit), or None."""
+    pending = os.path.join(sweep_dir, PENDING)
+    try:
+        names = os.listdir(pending)
+    except OSError:
+        return None
+    random.shuffle(names)  # spread workers over the queue
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        claim = os.path.join(sweep_dir, CLAIMED, "%s.%s" % (name, worker_id))
+        try:
+            os.rename(os.path.join(pending, name), claim)
+        except OSError:
+            continue
+        os.utime(claim, None)
+        try:
+            return (claim, read_json(claim))
+        except (IOError, ValueError):
+            continue
+    return None
+
+
+def run_unit(unit):
+    try:
+        return dict(unit=unit["unit"],
+                    result=simulate(unit["config"], unit["seed"]).as_dict())
+    except Exception, e:
+        logging.debug(traceback.format_exc())
+        return dict(unit=unit["unit"],
+                    error="%s: %s" % (e.__class__.__name__, e))
+
+
+def run_worker(queue_dir, lease, idle_exit, sweep=None, poll=0.2):
+    """Run units from every open sweep in queue_dir, or only from sweep
+    (then stopping once it is done)."""
+    worker_id = "%s-%d" % (socket.gethostname(), os.getpid())
+    idle_since = time.time()
+    while True:
+        if sweep is not None:
+            sweep_dir = os.path.join(queue_dir, sweep)
+            if os.path.exists(os.path.join(sweep_dir, DONE)):
+                break
+            sweep_dirs = [sweep_dir]
+        elif os.path.isdir(queue_dir):
+            sweep_dirs = open_sweeps(queue_dir)
+            random.shuffle(sweep_dirs)
+        else:
+            sweep_dirs = []
+        claimed = None
+        for sweep_dir in sweep_dirs:
+            claimed = claim_unit(sweep_dir, worker_id)
+            if claimed is not None:
+                break
+        if claimed is None:
+            if idle_exit and time.time() - idle_since > idle_exit:
+                break
+            time.sleep(poll)
+            continue
+        (claim, unit) = claimed
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat,
+                                args=(claim, lease / 3.0, stop))
+        beat.daemon = True
+        beat.start()
+        try:
+            result = run_unit(unit)
+        finally:
+            stop.set()
+        write_json(os.path.join(sweep_dir, RESULTS, unit["unit"]), result)
+        try:
+            os.remove(claim)
+        except OSError:
+            pass
+        idle_since = time.time()
+
+
+def main(args):
+    usage_msg = "Usage:  %prog coordinator|worker --dir DIR [options]"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--dir",
+                      dest="dir", default=None,
+                      help="Shared work directory")
+
+    parser.add_option("--lease",
+                      dest="lease", default=30.0, type="float",
+                      help="Seconds without a heartbeat before a unit is retried")
+
+    parser.add_option("--max-attempts",
+                      dest="max_attempts", default=3, type="int",
+                      help="Give up on a unit after this many lost workers")
+
+    parser.add_option("--local-workers",
+                      dest="local_workers", default=0, type="int",
+                      help="Coordinator: also start N workers on this host")
+
+    parser.add_option("--idle-exit",
+                      dest="idle_exit", default=0, type="float",
+                      help="Worker: exit after this many idle seconds (0 = never, or once --sweep is done)")
+
+    parser.add_option("--sweep",
+                      dest="sweep", default=None,
+                      help="Worker: only run units of this sweep id, and exit once it is done")
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Logging level (logged to stderr)")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ("coordinator", "worker") \
+            or options.dir is None:
+        parser.print_help()
+        sys.exit(1)
+
+    configure_logging(options.loglevel, sys.stderr)
+    if args[0] == "worker":
+        # Agents print from post_init(); keep stdout clean.
+        sys.stdout = sys.stderr
+        run_worker(options.dir, options.lease, options.idle_exit,
+                   options.sweep)
+        return
+
+    requests = [json.loads(line) for line in sys.stdin if line.strip()]
+    sweep = new_sweep_id()
+    units = split_sweep(requests)
+    coordinator = Coordinator(options.dir, sweep, options.lease,
+                              options.max_attempts)
+    coordinator.submit(units)
+
+    local = []
+    for i in range(options.local_workers):
+        local.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "worker",
+             "--dir", options.dir, "--sweep", sweep,
+             "--lease", str(options.lease), "--loglevel", options.loglevel]))
+    try:
+        results = coordinator.wait([name for (name, config, seed) in units])
+    except:
+        for proc in local:
+            proc.terminate()
+        raise
+    for proc in local:
+        proc.wait()
+
+    for response in merge_results(requests, results):
+        sys.stdout.write(json.dumps(response, separators=(",", ":")) + "\n")
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    main(sys.argv)